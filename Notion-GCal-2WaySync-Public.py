@@ -1,9 +1,42 @@
 import os
+import sys
+import re
+import json
+import uuid
+import hashlib
+import math
+import bisect
+import argparse
+import atexit
+import time
+import queue
+import random
+import io
+import cProfile
+import pstats
+import tracemalloc
+import importlib.util
 from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
 from datetime import datetime, timedelta, date
+from zoneinfo import ZoneInfo
+from functools import lru_cache
+from dateutil.rrule import rrulestr
+from collections import OrderedDict, Counter, deque
+from contextlib import nullcontext
+from urllib.parse import urlsplit, unquote
+from dataclasses import dataclass, field, asdict
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 import pickle
+import threading
+import httplib2
+import httpx
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import set_user_agent
+from googleapiclient.errors import HttpError
+from google.auth.exceptions import RefreshError
+from concurrent.futures import ThreadPoolExecutor
 
 
 ###########################################################################
@@ -23,22 +56,22 @@ runScript = "python3 GCalToken.py" #This is the command you will be feeding into
 
 credentialsLocation = "token.pkl" #This is where you keep the pickle file that has the Google Calendar Credentials
 
+gcalCacheLocation = "gcalEventCache.json" #This is where the script remembers what each GCal event looked like the last time it saw it
+tombstoneLocation = "deletionTombstones.json" #This is where the script remembers the GCal events it couldn't delete, and when to try them again
+journalLocation = "syncJournal.jsonl" #This is where the script writes down every change before it makes it, so a run that gets cut off can be cleaned up by the next one
+outboxLocation = "outbox.json" #This is where changes wait while GCal or Notion can't be reached. They get sent as soon as it's back
+lockLocation = "syncRun.lock" #This file is there while a run is syncing, so a second run started at the same time knows to wait or skip
+skippedRunsLocation = "skippedRuns.jsonl" #Every run that got skipped because another one was still going gets written down here
 
-DEFAULT_EVENT_LENGTH = 60 #This is how many minutes the default event length is. Feel free to change it as you please
-timezone = 'America/New_York' #Choose your respective time zone: http://www.timezoneconverter.com/cgi-bin/zonehelp.tzc
+LOCK_HEARTBEAT_SECONDS = 30 #How often a run that's syncing touches its lock file to show it's still going
+LOCK_STALE_SECONDS = 300 #A lock file that hasn't been touched for this long was left behind by a run that died, so it gets taken over
 
-def notion_time():
-    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S-04:00") #Change the last 5 characters to be representative of your timezone
-     #^^ has to be adjusted for when daylight savings is different if your area observes it
-    
-def DateTimeIntoNotionFormat(dateTimeValue):
-    return dateTimeValue.strftime("%Y-%m-%dT%H:%M:%S-04:00")  #Change the last 5 characters to be representative of your timezone
-     #^^ has to be adjusted for when daylight savings is different if your area observes it
+GCAL_CACHE_MAX_EVENTS = 5000 #How many GCal events get remembered. Once there are more, the ones that haven't been seen for the longest are forgotten
 
 
-def googleQuery():
-    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")+"-04:00" #Change the last 5 characters to be representative of your timezone
-     #^^ has to be adjusted for when daylight savings is different if your area observes it
+DEFAULT_EVENT_LENGTH = 60 #This is how many minutes the default event length is. Feel free to change it as you please
+timezone = 'America/New_York' #Choose your respective time zone from the "TZ database name" column here: https://en.wikipedia.org/wiki/List_of_tz_database_time_zones
+#^^ daylight savings is taken care of for you, so this is the only time zone setting there is
 
 
 DEFAULT_EVENT_START = 8 #8 would be 8 am. 16 would be 4 pm. Only whole numbers 
@@ -46,6 +79,10 @@ DEFAULT_EVENT_START = 8 #8 would be 8 am. 16 would be 4 pm. Only whole numbers
 AllDayEventOption = 0 #0 if you want dates on your Notion dashboard to be treated as an all-day event
 #^^ 1 if you want dates on your Notion dashboard to be created at whatever hour you defined in the DEFAULT_EVENT_START variable
 
+FIND_FREE_SLOTS = 0 #1 if tasks with only a date should go in the first free gap on their calendar from DEFAULT_EVENT_START on, instead of all landing at the same time
+#^^ only used when AllDayEventOption is 1. If there's no gap long enough that day, the task goes at DEFAULT_EVENT_START like before
+LATEST_DEFAULT_END = 18 #The gap has to end by this hour (18 would be 6 pm)
+
 
 
 ### MULTIPLE CALENDAR PART:
@@ -64,6 +101,11 @@ calendarDictionary = {
     'Test' : 'fd34893uklhjdflgkjsdafdfjklsd@group.calendar.google.com', #just typed some random ids but put the one for your calendars here
     'New Test' : 'skdhvjhefoierjkh345378khkh@group.calendar.google.com'
 }
+#^^ every run checks these against the calendars your Google account can see and the options of the Notion Calendar select, and stops right away if one is wrong
+#A Notion Calendar option that isn't in here but has a GCal calendar with the exact same name gets picked up on its own
+
+calendarListLocation = "calendarList.json" #This is where the list of calendars your Google account can see is kept between runs
+CALENDAR_LIST_TTL_HOURS = 24 #How many hours that list is used for before GCal gets asked for it again
 
 
 ## doesn't delete the Notion task (yet), I'm waiting for the Python API to be updated to allow deleting tasks
@@ -71,6 +113,86 @@ DELETE_OPTION = 0
 #set at 0 if you want the delete column being checked off to mean that the gCal event and the Notion Event will be checked off. 
 #set at 1 if you want nothing deleted
 
+DELETE_RETRY_MINUTES = 30 #If deleting a GCal event fails, it's tried again after this many minutes, then twice as long after that, and so on
+DELETE_RETRY_MAX_HOURS = 24 #The longest it'll wait between tries
+
+
+### SYNC WINDOW
+#Only events that start inside this window get synced, both on Notion and on GCal. The default is today and the week after it
+#The smaller the window, the quicker each run is. To bring in older events once, use the backfill command instead of making the window bigger
+SYNC_PAST_DAYS = 0 #How many days before today the window starts
+SYNC_FUTURE_DAYS = 7 #How many days after today the window ends
+
+BACKFILL_CHUNK_DAYS = 30 #backfill goes through the past this many days at a time
+backfillCheckpointLocation = "backfillCheckpoint.json" #This is where backfill remembers how far it got, so it can carry on if it gets cut off
+importCheckpointLocation = "importCheckpoint.jsonl" #This is where import writes down every event it has brought over, so a restarted import skips them
+
+VERIFY_PAST_DAYS = 365 #reconcile checks that Notion and GCal agree from this many days back up to the end of the sync window
+verifyReportLocation = "verifyReport.json" #This is where reconcile writes down what it found, so a nightly check can be looked at later
+
+profileLocation = "profiles" #This is the folder --profile, --trace-memory and --flame-graph write their reports to (one set of files for every phase)
+PROFILE_TOP_LINES = 30 #How many of the slowest functions (and the biggest allocation sites) go into each report
+FLAME_GRAPH_SAMPLE_SECONDS = 0.005 #How often --flame-graph looks at what every thread is doing. Smaller is more exact but slows the run down more
+
+
+### SCHEDULE (only used by the daemon command)
+#Instead of checking every 5 minutes no matter what, the daemon waits longer while nothing is changing and checks more often while things are being edited
+#The sync is split into phases that each keep their own schedule:
+#  push = Notion tasks that are new or were changed go to GCal (Parts 1 and 2)
+#  pull = GCal events that are new or were changed come back to Notion (Parts 3 and 4)
+#  delete = tasks checked off as Done get deleted from GCal (Part 5)
+DAEMON_MIN_INTERVAL = 60 #The shortest wait (in seconds) between checks, used while changes keep coming in
+DAEMON_MAX_INTERVAL = 1800 #The longest wait (in seconds) between checks, reached once nothing has changed for a while
+DAEMON_IDLE_CYCLES = 2 #How many checks in a row have to find nothing before the wait starts getting longer
+DAEMON_BACKOFF = 2 #Every check after that which finds nothing makes the wait this many times longer. A check that finds changes halves it
+PHASE_CADENCE = {'pull': 1, 'push': 1, 'delete': 4} #Each phase's waits are this many times the ones above, e.g. 4 means deletions are checked a quarter as often
+
+
+### PRIORITY TIERS
+#Events are split into tiers by when they start, so the ones coming up soonest always get synced first
+#  days = the tier holds events starting from today until the end of this many days from today (None = everything else, including the days before today)
+#  cadence = under the daemon, the tier's waits are this many times the ones in SCHEDULE
+#  maxWait = under the daemon, the tier is never left unchecked for longer than this many seconds, however quiet things are
+#  share = the part of MAX_CHANGES_PER_RUN kept for the tier. Whatever a tier doesn't use goes to the tiers that need more, most urgent first
+SYNC_TIERS = {
+    'today': {'days': 1, 'cadence': 1, 'maxWait': 300, 'share': 0.6},
+    'week': {'days': 7, 'cadence': 2, 'maxWait': 3600, 'share': 0.3},
+    'later': {'days': None, 'cadence': 6, 'maxWait': 6 * 3600, 'share': 0.1},
+}
+MAX_CHANGES_PER_RUN = 300 #The most changes one run will make. The rest wait for the next run (0 for no limit)
+
+
+### API QUOTAS
+#Google Calendar only allows so many calls a day (check the Quotas page of your project in the Google Cloud Console) and Notion only about 3 a second
+#Every call either API gets is counted, and the counts add up over the day across runs. They start over at midnight Pacific time, like Google's quota does
+#Once a run would leave less than QUOTA_RESERVE of a budget, only the first priority tier gets synced until the counts start over
+DAILY_CALL_BUDGETS = {'GCal': 100000, 'Notion': 200000} #How many calls the script is allowed to make to each API in a day
+QUOTA_RESERVE = 0.1 #The share of each budget that's kept for the most urgent events
+quotaLocation = "apiQuota.json" #This is where the counts are kept. It also has the totals per API, per kind of call and per calendar, so you can keep an eye on it
+
+
+### RETRIES
+#When a call fails for a reason that might go away (the API being too busy, a server error, the internet dropping out) it's tried again after a short wait
+#that doubles every time. If an API keeps failing anyway, it gets left alone for a while instead of being hit with even more calls
+RETRY_ATTEMPTS = 5 #How many times a call is tried in total before giving up on it
+RETRY_BASE_SECONDS = 1 #The wait before the first retry
+RETRY_MAX_SECONDS = 60 #The longest wait between tries (unless the API itself asks for a longer one)
+BREAKER_WINDOW = 20 #How many of the latest calls to each API are looked at
+BREAKER_ERROR_RATE = 0.5 #If at least this share of them failed, calls to that API are stopped for a bit
+BREAKER_COOLDOWN = 120 #How many seconds they're stopped for. After that, one call is let through to see if the API is working again
+
+
+### SPEED SETTINGS
+GCAL_MAX_WORKERS = 4 #How many Google Calendar reads can be running at the same time. Each calendar is listed/checked in parallel up to this number
+GCAL_BATCH_SIZE = 50 #How many GCal changes get sent together in one request (GCal allows up to 50)
+NOTION_MAX_WORKERS = 3 #How many Notion changes can be sent at the same time. Notion only allows about 3 requests a second, so going higher won't help
+NOTION_REQUESTS_PER_SECOND = 3 #import never makes pages faster than this (Notion's limit is about 3 a second on average)
+
+HTTP_TIMEOUT = 30 #How many seconds a request to either GCal or Notion can take before giving up
+NOTION_MAX_CONNECTIONS = 10 #How many connections to Notion can be kept open at once
+NOTION_KEEPALIVE_SECONDS = 60 #How long an unused Notion connection is kept open so the next request doesn't have to reconnect
+NOTION_HTTP2 = 0 #1 if you want to talk to Notion over HTTP/2 (you'll need to "pip install httpx[http2]"), 0 for regular HTTP/1.1
+
 
 ##### DATABASE SPECIFIC EDITS
 
@@ -92,44 +214,872 @@ Calendar_Notion_Name = 'Calendar'
 Current_Calendar_Id_Notion_Name = 'Current Calendar Id'
 Delete_Notion_Name = 'Done?'
 
+#Every run checks that these properties are there (with the right types) before it changes anything, and stops if one isn't
+notionSchemaLocation = "notionSchema.json" #This is where the database's properties are kept between runs
+NOTION_SCHEMA_TTL_HOURS = 24 #How many hours they're used for before Notion gets asked for them again
+
+
+##### WHAT GETS DOWNLOADED
+#To keep each run light, only the fields below are downloaded from GCal and only the properties below are downloaded from Notion
+#If you edit the code to read another GCal field or Notion property, add it here too or it'll come back empty
+
+GCAL_EVENT_FIELDS = 'id,etag,summary,description,start,end,source,organizer/email,status,recurrence,recurringEventId,originalStartTime'
+GCAL_LIST_FIELDS = 'nextPageToken,items(' + GCAL_EVENT_FIELDS + ')'
+
+NOTION_QUERY_PROPERTIES = [
+    Task_Notion_Name,
+    Date_Notion_Name,
+    Initiative_Notion_Name,
+    ExtraInfo_Notion_Name,
+    GCalEventId_Notion_Name,
+    Calendar_Notion_Name,
+    Current_Calendar_Id_Notion_Name,
+]
+
 #######################################################################################
 ###               No additional user editing beyond this point is needed            ###
 #######################################################################################
 
 
+#These are the commands you can give the script when you run it, e.g. "python Notion-GCal-2WaySync-Public.py push --calendar Work --dry-run"
+#Running it with no command does a full sync (the same as "sync"), so "python Notion-GCal-2WaySync-Public.py --dry-run" still works too
+#Each direction can be run on its own, e.g. from cron: a push every few minutes only reads the Notion tasks and writes to GCal, without paying
+#for the per-event checks and calendar listings that pulling takes. The full reconcile reads everything, so it only needs to run once in a while
+SYNC_PHASES = ('push', 'pull', 'delete')
+COMMAND_PHASES = {
+    'sync': SYNC_PHASES, #Parts 1-5
+    'push': ('push',), #Parts 1 and 2: new and changed Notion tasks go to GCal
+    'pull': ('pull',), #Parts 3 and 4: new and changed GCal events come back to Notion
+    'delete': ('delete',), #Part 5: tasks checked off as Done get deleted from GCal
+}
+
+def dayArgument(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+#options more than one command takes
+runOptions = argparse.ArgumentParser(add_help=False)
+runOptions.add_argument('--dry-run', action='store_true', help='only print what would be changed (and roughly how many API calls it would take) without changing anything')
+runOptions.add_argument('--wait', action='store_true', help='if another run is still syncing, wait for it to finish instead of skipping this run')
+runOptions.add_argument('--profile', action='store_true', help='time every function in each phase with cProfile and write the slowest ones to the profiles folder')
+runOptions.add_argument('--trace-memory', action='store_true', help='track the memory each phase uses with tracemalloc and write the peak and the biggest allocation sites to the profiles folder')
+runOptions.add_argument('--flame-graph', action='store_true', help='also write a collapsed-stack file for each phase to the profiles folder (for flamegraph.pl or speedscope)')
+calendarOptions = argparse.ArgumentParser(add_help=False)
+calendarOptions.add_argument('--calendar', action='append', dest='calendars', metavar='NAME', help='only look at this calendar (give it more than once for more than one). All of them if left out')
+windowOptions = argparse.ArgumentParser(add_help=False)
+windowOptions.add_argument('--from', dest='windowStart', type=dayArgument, metavar='YYYY-MM-DD', help='start the window on this day instead of SYNC_PAST_DAYS ago')
+windowOptions.add_argument('--to', dest='windowEnd', type=dayArgument, metavar='YYYY-MM-DD', help='end the window after this day instead of SYNC_FUTURE_DAYS from now')
+
+parser = argparse.ArgumentParser(description='2 way sync between a Notion database and Google Calendar')
+parser.set_defaults(dry_run=False, wait=False, profile=False, trace_memory=False, flame_graph=False, calendars=None, windowStart=None, windowEnd=None, plan_file=None)
+commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+for command, helpText in [
+    ('sync', 'sync both ways and delete what was checked off as Done (what running the script with no command does)'),
+    ('push', 'only send new and changed Notion tasks to GCal'),
+    ('pull', 'only bring new and changed GCal events back to Notion'),
+    ('delete', 'only delete the GCal events of tasks checked off as Done'),
+]:
+    #deleting doesn't look at the sync window (a task checked off as Done gets deleted whenever it is), so delete doesn't take --from and --to
+    commandParser = commands.add_parser(command, parents=[runOptions, calendarOptions] + ([windowOptions] if command != 'delete' else []), help=helpText)
+    commandParser.add_argument('--plan-file', help='also save the plan of changes to this file as JSON')
+commands.add_parser('reconcile', parents=[runOptions, calendarOptions, windowOptions], help='cheaply check that Notion and GCal agree over the last VERIFY_PAST_DAYS days, then sync only the days where they don\'t')
+commands.add_parser('import', parents=[runOptions, calendarOptions], help='bring every event on the calendars over to Notion, then stop. Safe to run again if it gets cut off')
+commands.add_parser('backfill', parents=[runOptions, calendarOptions], help='sync everything from a date up to the start of the sync window, a chunk at a time (carries on where it stopped if it got cut off)').add_argument('since', type=dayArgument, metavar='YYYY-MM-DD')
+commands.add_parser('conflicts', parents=[calendarOptions, windowOptions], help='list the events that overlap each other on each calendar in the sync window, then stop')
+commands.add_parser('daemon', parents=[runOptions, calendarOptions], help='keep running and sync again whenever each phase is due (see SCHEDULE in the set-up section)').add_argument(
+    '--phases', nargs='+', choices=SYNC_PHASES, default=SYNC_PHASES, help='only run these phases (e.g. a second daemon could do just the deletions)')
+
+commandLine = sys.argv[1:]
+if len(commandLine) == 0 or (commandLine[0].startswith('-') and commandLine[0] not in ('-h', '--help')):
+    commandLine = ['sync'] + commandLine
+args = parser.parse_args(commandLine)
+
+
+
+
+#ONLY ONE RUN AT A TIME
+#Two runs syncing at once (a cycle that took too long, or running the script by hand while the loop is going) would both make the same
+#GCal events and Notion pages. So the first run makes the lock file, and any other run either waits for it to go away (--wait) or is skipped
+#That goes for every command, so a push from cron never runs in the middle of a pull or a reconcile
+#The daemon only holds the lock while a check is running (see runDaemon), so other runs can go in while it's waiting for the next one
+#The run holding the lock touches the file every LOCK_HEARTBEAT_SECONDS. If it's older than LOCK_STALE_SECONDS, the run that made it died without
+#cleaning up (a crash, the computer turning off, ...) and the lock gets taken over
+#A run that finds its lock taken over (e.g. the computer slept for longer than LOCK_STALE_SECONDS) stops before its next change (see check)
+
+class LostRunLock(Exception):
+    pass
+
+
+class RunLock:
+    def __init__(self, location):
+        self.location = location
+        self.token = str(uuid.uuid4()) #so a run only ever deletes its own lock
+        self.held = False
+        self.lost = False
+        self.stopHeartbeat = threading.Event()
+
+    def readHolder(self, location=None):
+        try:
+            with open(location or self.location) as f:
+                return json.load(f)
+        except (OSError, ValueError): #gone already, or the run that made it hasn't written into it yet
+            return None
+
+    def isStale(self, location):
+        return time.time() - os.path.getmtime(location) >= LOCK_STALE_SECONDS
+
+    def takeOver(self):
+        #Renaming the lock is something only one run can do, so two runs can't both take over the same stale lock
+        stalePath = self.location + '.' + self.token + '.stale'
+        try:
+            os.rename(self.location, stalePath)
+        except OSError: #another run got there first (or it just went away)
+            return
+        if not self.isStale(stalePath): #it got touched in the meantime, so its run is still going after all
+            try:
+                os.rename(stalePath, self.location)
+            except OSError:
+                os.remove(stalePath)
+            return
+        holder = self.readHolder(stalePath) or {}
+        print(f"Taking over the lock left behind by a run that stopped (process {holder.get('pid', '?')})")
+        os.remove(stalePath)
+
+    def tryAcquire(self):
+        try:
+            lockFile = os.open(self.location, os.O_CREAT | os.O_EXCL | os.O_WRONLY) #fails if the file is already there, in one step
+        except FileExistsError:
+            try:
+                if not self.isStale(self.location):
+                    return False
+            except OSError: #it went away while we were looking
+                return False
+            self.takeOver()
+            return False #the next try makes a fresh lock (if no other run made one first)
+        with os.fdopen(lockFile, 'w') as f:
+            json.dump({'token': self.token, 'pid': os.getpid(), 'startedAt': datetime.now().isoformat(timespec='seconds')}, f)
+        self.held = True
+        self.lost = False
+        self.stopHeartbeat = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(self.stopHeartbeat,), daemon=True).start()
+        return True
+
+    def acquire(self, wait):
+        waiting = False
+        while not self.tryAcquire():
+            if not wait:
+                return False
+            if not waiting:
+                print('Waiting for the run that is syncing right now to finish')
+                waiting = True
+            time.sleep(5)
+        return True
+
+    def isOurs(self):
+        holder = self.readHolder()
+        return holder != None and holder.get('token') == self.token
+
+    def markLost(self):
+        print('Another run has taken over the lock, so this run stops before changing anything else')
+        self.lost = True
+        self.held = False
+        self.stopHeartbeat.set()
+
+    def heartbeat(self, stopHeartbeat):
+        while not stopHeartbeat.wait(LOCK_HEARTBEAT_SECONDS):
+            if not self.isOurs():
+                self.markLost()
+                return
+            try:
+                os.utime(self.location)
+            except OSError: #it went away just now, which the next beat (or check) notices
+                pass
+
+    def check(self):
+        #called before every change. The heartbeat can be late after the computer wakes up, so the lock file itself is looked at too
+        if self.held and not self.isOurs():
+            self.markLost()
+        if self.lost:
+            raise LostRunLock('this run lost its lock to another run')
+
+    def release(self):
+        if not self.held:
+            return
+        self.stopHeartbeat.set()
+        holder = self.readHolder()
+        if holder != None and holder['token'] == self.token:
+            os.remove(self.location)
+        self.held = False
+
+
+def recordSkippedRun():
+    holder = runLock.readHolder() or {}
+    print(f"Another run (process {holder.get('pid', '?')}, started {holder.get('startedAt', '?')}) is still syncing, so this run is skipped")
+    with open(skippedRunsLocation, 'a') as f:
+        f.write(json.dumps({'skippedAt': datetime.now().isoformat(timespec='seconds'), 'command': args.command, 'heldBy': holder}) + '\n')
+
+
+runLock = RunLock(lockLocation)
+atexit.register(runLock.release)
+#dry runs and conflicts only read (and leave the journal and outbox alone), so they can run alongside a sync
+if not args.dry_run and args.command not in ('conflicts', 'daemon'):
+    if not runLock.acquire(wait=args.wait):
+        recordSkippedRun()
+        raise SystemExit(0)
+
+
+
+#SET UP THE CONNECTIONS TO BOTH APIS
+
+#Every connection that gets opened costs a TLS handshake, so we keep them open and reuse them for as long as possible
+#These numbers keep track of how many requests were sent and how many of them had to open a brand new connection
+connectionStats = {
+    'GCal': {'requests': 0, 'newConnections': 0},
+    'Notion': {'requests': 0, 'newConnections': 0},
+}
+connectionStatsLock = threading.Lock()
+
+def countConnectionStat(api, stat):
+    with connectionStatsLock:
+        connectionStats[api][stat] += 1
+
+
+QUOTA_DAY_ZONE = ZoneInfo('America/Los_Angeles') #Google's quota day starts at midnight Pacific time
+
+class ApiQuota:
+    #Counts every call made to each API, split up by endpoint (the kind of call, e.g. "GET calendars/events") and tenant (the GCal calendar or Notion database it was for)
+    #The counts are saved to a file so they keep adding up over the day, and start over once the quota day changes
+    def __init__(self, location, budgets):
+        self.location = location
+        self.budgets = budgets
+        self.lock = threading.RLock()
+        self.day = self.today()
+        self.calls = {api: {} for api in budgets} #api -> endpoint -> tenant -> how many calls
+        try:
+            with open(location) as f:
+                saved = json.load(f)
+            if saved['day'] == self.day:
+                for api in budgets:
+                    self.calls[api] = saved['calls'].get(api, {})
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def today(self):
+        return datetime.now(QUOTA_DAY_ZONE).date().isoformat()
+
+    def count(self, api, endpoint, tenant):
+        with self.lock:
+            if self.today() != self.day: #the quota day started over in the middle of a run
+                self.day = self.today()
+                self.calls = {api: {} for api in self.budgets}
+            byTenant = self.calls[api].setdefault(endpoint, {})
+            byTenant[tenant] = byTenant.get(tenant, 0) + 1
+
+    def used(self, api):
+        with self.lock:
+            return sum(count for byTenant in self.calls[api].values() for count in byTenant.values())
+
+    def remaining(self, api):
+        return self.budgets[api] - self.used(api)
+
+    def usedSoFar(self):
+        #how many calls each API has had today, to take the difference before and after something to see what it cost
+        return Counter({api: self.used(api) for api in self.budgets})
+
+    def wouldRunLow(self, cost):
+        #cost is a Counter of how many more calls are about to be made to each API
+        return any(self.remaining(api) - cost[api] < self.budgets[api] * QUOTA_RESERVE for api in self.budgets)
+
+    def save(self):
+        with self.lock:
+            summary = {}
+            for api, byEndpoint in self.calls.items():
+                byTenant = Counter()
+                for tenantCounts in byEndpoint.values():
+                    byTenant.update(tenantCounts)
+                summary[api] = {
+                    'budget': self.budgets[api],
+                    'used': self.used(api),
+                    'remaining': self.remaining(api),
+                    'byEndpoint': {endpoint: sum(tenantCounts.values()) for endpoint, tenantCounts in byEndpoint.items()},
+                    'byTenant': dict(byTenant),
+                    'failures': dict(circuitBreakers[api].stats), #since the script was started (see classifyError)
+                }
+            with open(self.location, 'w') as f:
+                json.dump({'day': self.day, 'savedAt': datetime.now().isoformat(timespec='seconds'), 'summary': summary, 'calls': self.calls}, f, indent=2)
+
+
+apiQuota = ApiQuota(quotaLocation, DAILY_CALL_BUDGETS)
+
+
+######################################################################
+#METHODS FOR RETRYING FAILED CALLS
+#Every call to GCal or Notion goes through callApi, which works out why a call failed before deciding what to do about it
+#A 404 is an answer ("that event isn't there") and gets passed straight back, while throttling, server errors and dropped connections get retried
+
+RETRYABLE_ERRORS = ('throttled', 'server', 'network')
+
+def classifyError(e):
+    #returns what went wrong, and how many seconds the API asked us to wait before trying again (None if it didn't say)
+    if isinstance(e, HttpError):
+        status, headers, body = e.resp.status, e.resp, e.content
+    elif isinstance(e, HTTPResponseError):
+        status, headers, body = e.status, e.headers, e.body
+    elif isinstance(e, (RequestTimeoutError, httpx.TransportError, httplib2.HttpLib2Error, OSError)):
+        return 'network', None
+    elif isinstance(e, RefreshError): #the saved Google token can't be used any more
+        return 'auth', None
+    else:
+        return 'unknown', None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+
+    if status == 304:
+        kind = 'not_modified'
+    elif status == 401:
+        kind = 'auth'
+    elif status in (404, 410):
+        kind = 'not_found'
+    elif status == 409 and isinstance(e, HTTPResponseError): #Notion answers 409 when two saves to the same page run into each other, and asks for it to be sent again
+        kind = 'server'
+    elif status == 409:
+        kind = 'conflict'
+    elif status == 429 or (status == 403 and 'ratelimitexceeded' in (body or '').lower()): #GCal says it's throttling with a 403 and a rateLimitExceeded reason
+        kind = 'throttled'
+    elif status >= 500:
+        kind = 'server'
+    else:
+        kind = 'client'
+
+    try:
+        retryAfter = float(headers.get('retry-after'))
+    except (TypeError, ValueError): #not there, or given as a date, which neither API does
+        retryAfter = None
+    return kind, retryAfter
+
+
+def retryDelay(attempt, retryAfter):
+    #a random wait up to the doubled delay, so the threads that were throttled together don't all come back at the same moment
+    delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+    if retryAfter != None:
+        delay = max(delay, retryAfter)
+    return delay
+
+
+class ApiUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    #Keeps track of how the last BREAKER_WINDOW calls to one API went. Once too many of them failed for reasons that aren't our fault,
+    #the breaker opens and every call to that API fails straight away for BREAKER_COOLDOWN seconds
+    #After that only one call is let through (the others still fail straight away while it's out): if it works things go back to normal,
+    #and if it doesn't the breaker opens again
+    def __init__(self, api):
+        self.api = api
+        self.lock = threading.Lock()
+        self.results = deque(maxlen=BREAKER_WINDOW) #True for every call that failed
+        self.state = 'closed'
+        self.openUntil = 0
+        self.trialInFlight = False #True while the one call let through after the cooldown hasn't come back yet
+        self.stats = Counter() #what's written to the quota file: calls, retries, times the breaker opened and how many of each kind of failure
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.monotonic() < self.openUntil:
+                    return False
+                self.state = 'half-open'
+            if self.state == 'half-open':
+                if self.trialInFlight:
+                    return False
+                self.trialInFlight = True
+            return True
+
+    def record(self, errorKind):
+        #errorKind is None if the call worked
+        failed = errorKind in RETRYABLE_ERRORS
+        with self.lock:
+            self.stats['calls'] += 1
+            if errorKind not in (None, 'not_modified'): #a 304 is GCal saying our copy is still good, which isn't a failure
+                self.stats[errorKind] += 1
+            if self.state == 'half-open':
+                self.trialInFlight = False
+                if failed:
+                    self.open()
+                else:
+                    self.state = 'closed'
+                return
+            self.results.append(failed)
+            #it only opens once there have been enough calls to tell, so one failure out of two calls doesn't stop everything
+            if failed and len(self.results) >= BREAKER_WINDOW // 2 and sum(self.results) >= BREAKER_ERROR_RATE * len(self.results):
+                self.open()
+
+    def open(self):
+        print(f'{self.api} keeps failing, so it is being left alone for {BREAKER_COOLDOWN} seconds')
+        self.state = 'open'
+        self.openUntil = time.monotonic() + BREAKER_COOLDOWN
+        self.results.clear()
+        self.stats['breakerOpened'] += 1
+
+    def countRetry(self):
+        with self.lock:
+            self.stats['retries'] += 1
+
+
+circuitBreakers = {'GCal': CircuitBreaker('GCal'), 'Notion': CircuitBreaker('Notion')}
+
+
+def callApi(api, call, idempotent=True):
+    #Runs call() (which makes one request to GCal or Notion) and tries it again if it failed for a reason that might go away
+    #Calls that aren't safe to send twice (making a Notion page) are only tried again when they were throttled, because then they never ran at all
+    breaker = circuitBreakers[api]
+    for attempt in range(RETRY_ATTEMPTS):
+        if not breaker.allow():
+            raise ApiUnavailable(api + ' has been failing too often, so it is being left alone for a bit')
+        try:
+            result = call()
+        except Exception as e:
+            errorKind, retryAfter = classifyError(e)
+            breaker.record(errorKind)
+            if api == 'Notion' and isinstance(e, HTTPResponseError) and e.status == 400:
+                forgetNotionSchema()
+            if errorKind not in RETRYABLE_ERRORS or (not idempotent and errorKind != 'throttled') or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            breaker.countRetry()
+            time.sleep(retryDelay(attempt, retryAfter))
+            continue
+        breaker.record(None)
+        return result
+
+
+def isUnreachable(e):
+    #the API couldn't be reached at all (or kept failing), as opposed to it answering that something was wrong with the call itself
+    return isinstance(e, ApiUnavailable) or classifyError(e)[0] in RETRYABLE_ERRORS
+
+
+def countGCalCall(uri, method, body):
+    #Every call inside a batch counts against Google's quota on its own, so those are pulled out of the batch and counted one by one
+    #The requests that refresh the token aren't calendar calls, so they don't count
+    path = urlsplit(uri).path
+    if path.startswith('/batch/'):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        for innerMethod, innerUri in re.findall(r'^(GET|POST|PUT|PATCH|DELETE) (\S+) HTTP/1\.1', body or '', re.MULTILINE):
+            countGCalCall(innerUri, innerMethod, None)
+    elif '/calendar/v3/' in path:
+        #e.g. /calendar/v3/calendars/<calendar id>/events/<event id> is counted as "GET calendars/events" for that calendar
+        parts = [unquote(part) for part in path.split('/calendar/v3/', 1)[1].split('/')]
+        tenant = parts[1] if parts[0] == 'calendars' and len(parts) > 1 else 'account'
+        apiQuota.count('GCal', method + ' ' + '/'.join(parts[0::2]), tenant)
+
+
+class ReuseCountingHttp(httplib2.Http):
+    #httplib2 already keeps one keep-alive connection per host open on each Http object. This just counts how often it gets reused
+    def request(self, uri, method='GET', body=None, *args, **kwargs):
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+        conn = self.connections.get(scheme + ':' + authority)
+        countConnectionStat('GCal', 'requests')
+        if conn is None or conn.sock is None:
+            countConnectionStat('GCal', 'newConnections')
+        countGCalCall(uri, method, body)
+        return super().request(uri, method, body, *args, **kwargs)
+
+
+def buildCalendarService():
+    #each service object gets its own keep-alive connection. GCal only sends gzipped responses when "gzip" is in the user agent
+    http = AuthorizedHttp(credentials, http=ReuseCountingHttp(timeout=HTTP_TIMEOUT))
+    http = set_user_agent(http, 'Notion-GCal-2WaySync (gzip)')
+    return build("calendar", "v3", http=http)
+
+
+def traceNotionRequest(request):
+    #httpx tells us through the trace extension when it has to open a new connection for a request
+    def trace(eventName, info):
+        if eventName == 'connection.connect_tcp.complete':
+            countConnectionStat('Notion', 'newConnections')
+    request.extensions['trace'] = trace
+    countConnectionStat('Notion', 'requests')
+    #everything this script does on Notion is for the one database, so that's the tenant. /v1/pages/<page id> is counted as "PATCH pages"
+    parts = request.url.path.split('/')[2:]
+    apiQuota.count('Notion', request.method + ' ' + '/'.join(parts[0::2]), database_id)
+
+
+def buildNotionHttpClient():
+    http2 = False
+    if NOTION_HTTP2 == 1:
+        #httpx only needs the h2 package to be installed for HTTP/2, so this just checks that it's there without importing it
+        if importlib.util.find_spec('h2') != None:
+            http2 = True
+        else:
+            print('HTTP/2 for Notion needs "pip install httpx[http2]", using HTTP/1.1 instead')
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(max_connections=NOTION_MAX_CONNECTIONS, max_keepalive_connections=NOTION_MAX_CONNECTIONS, keepalive_expiry=NOTION_KEEPALIVE_SECONDS),
+        timeout=HTTP_TIMEOUT,
+        event_hooks={'request': [traceNotionRequest]},
+    )
+
+
+class GCalEventCache:
+    #Keeps the last version of every GCal event we've seen (along with its etag) keyed by calendar and event id, and saves it to a file between runs
+    #Once it holds more than maxEvents, the events that haven't been used for the longest get dropped
+    def __init__(self, location, maxEvents):
+        self.location = location
+        self.maxEvents = maxEvents
+        self.lock = threading.Lock()
+        self.events = OrderedDict()
+        try:
+            with open(location) as f:
+                for key, event in json.load(f):
+                    self.events[key] = event
+        except (OSError, ValueError): #first run or a broken file, either way we just start from scratch
+            pass
+        self.calendarOfEvent = {key.split('/', 1)[1]: key.split('/', 1)[0] for key in self.events}
+
+    def get(self, calendarId, eventId):
+        key = calendarId + '/' + eventId
+        with self.lock:
+            if key not in self.events:
+                return None
+            self.events.move_to_end(key)
+            return self.events[key]
+
+    def calendarOf(self, eventId): #the calendar we last saw this event on
+        return self.calendarOfEvent.get(eventId)
+
+    def put(self, calendarId, event):
+        key = calendarId + '/' + event['id']
+        with self.lock:
+            self.events[key] = event
+            self.events.move_to_end(key)
+            self.calendarOfEvent[event['id']] = calendarId
+            while len(self.events) > self.maxEvents:
+                oldKey, oldEvent = self.events.popitem(last=False)
+                if self.calendarOfEvent.get(oldEvent['id']) == oldKey.split('/', 1)[0]:
+                    del self.calendarOfEvent[oldEvent['id']]
+
+    def remove(self, calendarId, eventId):
+        with self.lock:
+            self.events.pop(calendarId + '/' + eventId, None)
+            if self.calendarOfEvent.get(eventId) == calendarId:
+                del self.calendarOfEvent[eventId]
+
+    def save(self):
+        with self.lock:
+            with open(self.location, 'w') as f:
+                json.dump(list(self.events.items()), f) #saved oldest to newest so the order survives to the next run
+
+
+class DeletionTombstones:
+    #Keeps the GCal events that Part 5 couldn't delete (keyed by event id), how many times it tried and when to try next, and saves it to a file between runs
+    #Every failed try doubles the wait, up to DELETE_RETRY_MAX_HOURS, so a stuck deletion doesn't cost calls on every run
+    def __init__(self, location):
+        self.location = location
+        self.lock = threading.Lock()
+        try:
+            with open(location) as f:
+                self.tombstones = json.load(f)
+        except (OSError, ValueError): #first run or a broken file, either way we just start from scratch
+            self.tombstones = {}
+
+    def shouldTry(self, eventId):
+        tombstone = self.tombstones.get(eventId)
+        return tombstone == None or datetime.strptime(tombstone['nextTry'], "%Y-%m-%dT%H:%M:%S") <= datetime.now()
+
+    def failed(self, eventId, pageId, error):
+        with self.lock:
+            attempts = self.tombstones.get(eventId, {}).get('attempts', 0) + 1
+            wait = min(timedelta(minutes=DELETE_RETRY_MINUTES * 2 ** (attempts - 1)), timedelta(hours=DELETE_RETRY_MAX_HOURS))
+            self.tombstones[eventId] = {
+                'pageId': pageId,
+                'attempts': attempts,
+                'nextTry': (datetime.now() + wait).strftime("%Y-%m-%dT%H:%M:%S"),
+                'lastError': error,
+            }
+
+    def succeeded(self, eventId):
+        with self.lock:
+            self.tombstones.pop(eventId, None)
+
+    def save(self):
+        with self.lock:
+            with open(self.location, 'w') as f:
+                json.dump(self.tombstones, f, indent=2)
+
+
+class CalendarRegistry:
+    #Looks calendars up both ways (name -> id and id -> name) in one step each. A calendar with two names goes by the first one
+    #It starts out as calendarDictionary, and refresh() checks it against the calendars your Google account can see (calendarList, which is kept in
+    #calendarListLocation so it's only asked for every CALENDAR_LIST_TTL_HOURS hours) and against the options of the Notion Calendar select
+    def __init__(self, calendars, location):
+        self.location = location
+        self.idOf = dict(calendars)
+        self.nameOf = {}
+        for name, calendarId in calendars.items():
+            self.nameOf.setdefault(calendarId, name)
+        self.defaultId = self.idOf.get(DEFAULT_CALENDAR_NAME)
+        self.fetchedAt = 0
+        self.listWasSaved = False #whether the last calendar list came from calendarListLocation instead of GCal
+
+    def names(self):
+        return list(self.nameOf.values()) #one name for every calendar
+
+    def syncedNames(self):
+        #the calendars this run looks at: the ones picked with --calendar, or all of them
+        if args.calendars == None:
+            return self.names()
+        pickedIds = {self.idOf[name] for name in args.calendars}
+        return [name for name in self.names() if self.idOf[name] in pickedIds]
+
+    def ids(self):
+        return list(self.nameOf.keys())
+
+    def add(self, name, calendarId):
+        self.idOf[name] = calendarId
+        self.nameOf.setdefault(calendarId, name)
+
+    def selectedId(self, properties):
+        #the calendar picked in a Notion page's Calendar select (None if it's empty or isn't one of the calendars)
+        select = properties[Calendar_Notion_Name]['select']
+        return self.idOf.get(select['name']) if select != None else None
+
+    def currentId(self, properties):
+        #the calendar the page's event was last put on (None if it hasn't been put on one)
+        try:
+            return properties[Current_Calendar_Id_Notion_Name]['rich_text'][0]['text']['content']
+        except (KeyError, IndexError):
+            return None
+
+    def readCalendarList(self, useSaved=True):
+        #id -> name of every calendar your Google account can see (None if it has to be asked for but GCal can't be reached)
+        try:
+            with open(self.location) as f:
+                saved = json.load(f)
+            if useSaved and time.time() - saved['fetchedAt'] < CALENDAR_LIST_TTL_HOURS * 3600:
+                self.fetchedAt = saved['fetchedAt']
+                self.listWasSaved = True
+                return saved['calendars']
+        except (OSError, ValueError, KeyError): #never read yet or a broken file, either way we ask GCal
+            pass
+        self.listWasSaved = False
+        calendars = {}
+        pageToken = None
+        while True:
+            try:
+                x = callApi('GCal', service.calendarList().list(pageToken=pageToken, fields='nextPageToken,items(id,summary,summaryOverride)').execute)
+            except Exception as e:
+                if not isUnreachable(e):
+                    raise
+                #GCal is down, so the calendars don't get checked this time (an old list could be missing a calendar you just added)
+                #and the GCal changes wait in the outbox
+                print('GCal can\'t be reached, so the calendars aren\'t checked against it this time')
+                return None
+            for item in x['items']:
+                calendars[item['id']] = item.get('summaryOverride', item.get('summary', '')) #summaryOverride is the name you gave someone else's calendar
+            pageToken = x.get('nextPageToken')
+            if pageToken == None:
+                break
+        self.fetchedAt = time.time()
+        with open(self.location, 'w') as f:
+            json.dump({'fetchedAt': self.fetchedAt, 'calendars': calendars}, f, indent=2)
+        return calendars
+
+    def refresh(self):
+        #returns the problems that would make the sync go wrong, after printing the ones it can live with
+        #If the saved list is missing one of the calendars, it might just be out of date (e.g. you just added one), so GCal gets asked once before giving up
+        gcalCalendars = self.readCalendarList()
+        if gcalCalendars != None and self.listWasSaved and any(calendarId not in gcalCalendars for calendarId in self.idOf.values()):
+            gcalCalendars = self.readCalendarList(useSaved=False)
+        problems = []
+        if self.defaultId == None:
+            problems.append(f'DEFAULT_CALENDAR_NAME ("{DEFAULT_CALENDAR_NAME}") has to be one of the names in calendarDictionary')
+        if gcalCalendars == None: #GCal couldn't be asked
+            gcalCalendars = dict(self.nameOf)
+        for name, calendarId in self.idOf.items():
+            if calendarId not in gcalCalendars:
+                problems.append(f'the calendar "{name}" ({calendarId}) isn\'t one your Google account can see')
+
+        options = [option['name'] for option in notionDatabase['properties'][Calendar_Notion_Name]['select']['options']]
+        idOfGCalName = {gcalName: calendarId for calendarId, gcalName in gcalCalendars.items()}
+        for option in options:
+            if option in self.idOf:
+                continue
+            if option in idOfGCalName:
+                print(f'Found the GCal calendar for the Notion Calendar option "{option}", so it gets synced too')
+                self.add(option, idOfGCalName[option])
+            else:
+                print(f'The Notion Calendar option "{option}" isn\'t one of your calendars, so tasks with it go on {DEFAULT_CALENDAR_NAME}')
+        for name in self.names():
+            if name not in options:
+                print(f'"{name}" isn\'t an option of the Notion Calendar select yet. Notion adds it the first time a task gets put on it')
+        for name in args.calendars or []:
+            if name not in self.idOf:
+                problems.append(f'"{name}" (from --calendar) isn\'t one of your calendars (they are: ' + ', '.join(self.idOf) + ')')
+        return problems
+
+    def refreshIfStale(self):
+        #for the daemon, which keeps running for longer than the calendar list is good for
+        if time.time() - self.fetchedAt >= CALENDAR_LIST_TTL_HOURS * 3600:
+            for problem in self.refresh():
+                print('Calendar problem: ' + problem)
+
+
+#The type each of the properties from the DATABASE SPECIFIC EDITS has to be
+NOTION_PROPERTY_TYPES = {
+    Task_Notion_Name: 'title',
+    Date_Notion_Name: 'date',
+    Initiative_Notion_Name: 'select',
+    ExtraInfo_Notion_Name: 'rich_text',
+    On_GCal_Notion_Name: 'checkbox',
+    NeedGCalUpdate_Notion_Name: 'formula',
+    GCalEventId_Notion_Name: 'rich_text',
+    LastUpdatedTime_Notion_Name: 'date',
+    Calendar_Notion_Name: 'select',
+    Current_Calendar_Id_Notion_Name: 'rich_text',
+    Delete_Notion_Name: 'checkbox',
+}
+
+def readNotionSchema(useSaved):
+    #returns the database (with its properties), when it was fetched, and whether it came from the file
+    if useSaved:
+        try:
+            with open(notionSchemaLocation) as f:
+                saved = json.load(f)
+            if saved['databaseId'] == database_id and time.time() - saved['fetchedAt'] < NOTION_SCHEMA_TTL_HOURS * 3600:
+                return saved['schema'], saved['fetchedAt'], True
+        except (OSError, ValueError, KeyError): #never fetched yet or a broken file, either way we ask Notion
+            pass
+    schema = callApi('Notion', lambda: notion.databases.retrieve(database_id=database_id))
+    fetchedAt = time.time()
+    with open(notionSchemaLocation, 'w') as f:
+        json.dump({'databaseId': database_id, 'fetchedAt': fetchedAt, 'schema': schema}, f, indent=2)
+    return schema, fetchedAt, False
+
+
+def findSchemaProblems(schema):
+    problems = []
+    for name, expectedType in NOTION_PROPERTY_TYPES.items():
+        prop = schema['properties'].get(name)
+        if prop == None:
+            problems.append(f'there is no "{name}" property in the Notion database')
+        elif prop['type'] != expectedType:
+            problems.append(f'"{name}" is a {prop["type"]} property, but it has to be a {expectedType}')
+    return problems
+
+
+def applyNotionSchema():
+    #reads the schema, checks it, and if it's right sets up everything that depends on it. Returns the problems found
+    #If the saved schema has problems, it might just be out of date (e.g. you just renamed a property), so Notion gets asked once before giving up
+    global notionDatabase, notionPropertyIds, notionSchemaFetchedAt
+    schema, fetchedAt, wasSaved = readNotionSchema(useSaved=True)
+    problems = findSchemaProblems(schema)
+    if len(problems) > 0 and wasSaved:
+        schema, fetchedAt, wasSaved = readNotionSchema(useSaved=False)
+        problems = findSchemaProblems(schema)
+    if len(problems) > 0:
+        return problems
+    notionDatabase = schema
+    notionPropertyIds = {name: prop['id'] for name, prop in schema['properties'].items()} #Notion wants these (not the names) when we only ask for some properties
+    notionSchemaFetchedAt = fetchedAt
+    return []
+
+
+def forgetNotionSchema():
+    #a 400 from Notion usually means a property doesn't match the saved schema anymore, so it gets fetched (and checked) again
+    global notionSchemaFetchedAt
+    notionSchemaFetchedAt = 0
+    try:
+        os.remove(notionSchemaLocation)
+    except OSError:
+        pass
+
+
+def refreshNotionSchemaIfStale():
+    #for the daemon, which keeps running for longer than the saved schema is good for. A cycle with a broken schema fails before it changes anything
+    if time.time() - notionSchemaFetchedAt >= NOTION_SCHEMA_TTL_HOURS * 3600:
+        problems = applyNotionSchema()
+        if len(problems) > 0:
+            raise ValueError('the Notion database is not set up right: ' + '; '.join(problems))
+
+
+def printConnectionReport():
+    for api, stats in connectionStats.items():
+        if stats['requests'] == 0:
+            continue
+        reused = stats['requests'] - stats['newConnections']
+        print(f"{api}: {stats['requests']} requests over {stats['newConnections']} connections ({100 * reused / stats['requests']:.0f}% reused)")
+    for api, budget in DAILY_CALL_BUDGETS.items():
+        print(f"{api}: {apiQuota.used(api)} of today's {budget} calls used")
+    for api, breaker in circuitBreakers.items():
+        failures = {kind: count for kind, count in breaker.stats.items() if kind not in ('calls', 'retries')}
+        if len(failures) > 0 or breaker.stats['retries'] > 0:
+            print(f"{api}: {breaker.stats['retries']} retries, " + ', '.join(f'{count} {kind}' for kind, count in failures.items()))
 
 
 #SET UP THE GOOGLE CALENDAR API INTERFACE
 
 credentials = pickle.load(open(credentialsLocation, "rb"))
-service = build("calendar", "v3", credentials=credentials)
+service = buildCalendarService()
 
 
 #There could be a hiccup if the Google Calendar API token expires. 
 #If the token expires, the other python script GCalToken.py creates a new token for the program to use
 #This is placed here because it can take a few seconds to start working and I want the most heavy tasks to occur first
+#Only a token that's no good gets a new one. If GCal is just down (or busy), the run carries on and the GCal changes wait in the outbox
 try:
-    calendar = service.calendars().get(calendarId=DEFAULT_CALENDAR_ID).execute()
-except:
-    #refresh the token
-    import os
-    os.system(runScript)    
+    calendar = callApi('GCal', service.calendars().get(calendarId=DEFAULT_CALENDAR_ID).execute)
+except Exception as e:
+    if classifyError(e)[0] != 'auth':
+        if not isUnreachable(e):
+            raise
+        print('GCal can\'t be reached right now, so carrying on without it: ' + str(e))
+        calendar = None
+    else:
+        #refresh the token
+        os.system(runScript)    
     
-    #SET UP THE GOOGLE CALENDAR API INTERFACE
+        #SET UP THE GOOGLE CALENDAR API INTERFACE
+
+        credentials = pickle.load(open(credentialsLocation, "rb"))
+        service = buildCalendarService()
 
-    credentials = pickle.load(open(credentialsLocation, "rb"))
-    service = build("calendar", "v3", credentials=credentials)
+        # result = service.calendarList().list().execute()
+        # print(result['items'][:])
 
-    # result = service.calendarList().list().execute()
-    # print(result['items'][:])
+        calendar = callApi('GCal', service.calendars().get(calendarId=DEFAULT_CALENDAR_ID).execute)
 
-    calendar = service.calendars().get(calendarId=calendarID).execute()
 
 
+#Google's client objects are not thread-safe, so every worker thread that reads from GCal gets its own service object
+#The pool is kept for the whole run so the worker threads (and their connections) are reused by Part 3 and Part 4
+threadLocalData = threading.local()
+gcalEventCache = GCalEventCache(gcalCacheLocation, GCAL_CACHE_MAX_EVENTS)
+deletionTombstones = DeletionTombstones(tombstoneLocation)
+gcalPool = ThreadPoolExecutor(max_workers=GCAL_MAX_WORKERS, thread_name_prefix='gcal')
+notionPool = ThreadPoolExecutor(max_workers=NOTION_MAX_WORKERS, thread_name_prefix='notion')
+
 
 ##This is where we set up the connection with the Notion API
 os.environ['NOTION_TOKEN'] = NOTION_TOKEN
-notion = Client(auth=os.environ["NOTION_TOKEN"])
+notion = Client(auth=os.environ["NOTION_TOKEN"], client=buildNotionHttpClient(), timeout_ms=HTTP_TIMEOUT*1000)
+
+#The database's properties get checked before anything is changed, so a property that's missing or renamed stops the run right here
+#(in at most one call to Notion) instead of making it fail halfway through. They're also what the queries use to only download what they need
+schemaProblems = applyNotionSchema()
+if len(schemaProblems) > 0:
+    print('The Notion database is not set up right:')
+    for problem in schemaProblems:
+        print('  - ' + problem)
+    raise SystemExit(1)
+
+#A calendar that's set up wrong gets caught here, before anything is synced, instead of making the run fail halfway through
+calendarRegistry = CalendarRegistry(calendarDictionary, calendarListLocation)
+calendarProblems = calendarRegistry.refresh()
+if len(calendarProblems) > 0:
+    print('The calendars are not set up right:')
+    for problem in calendarProblems:
+        print('  - ' + problem)
+    raise SystemExit(1)
 
 
 
@@ -140,6 +1090,198 @@ notion = Client(auth=os.environ["NOTION_TOKEN"])
 ###########################################################################
 
 
+######################################################################
+#METHODS TO READ FROM MULTIPLE CALENDARS AT THE SAME TIME
+
+def getThreadService():
+    #each worker thread builds its own service object the first time it is used and keeps it for the rest of the run
+    if not hasattr(threadLocalData, 'service'):
+        threadLocalData.service = buildCalendarService()
+    return threadLocalData.service
+
+
+def fanOutCalendarReads(readMethod, items):
+    #runs readMethod(threadService, item) for every item on the GCal worker pool
+    #the results come back in the same order as the items, so they can be merged as if they were read one after the other
+    #the whole thing takes about as long as the slowest read instead of the sum of all of them
+    return list(gcalPool.map(lambda item: readMethod(getThreadService(), item), items))
+
+
+######################################################################
+#METHODS FOR TIMES AND TIME ZONES
+#Every date and time the script reads (from Notion or GCal) is turned into a timezone-aware datetime in your time zone,
+#so the same moment always compares as equal no matter which UTC offset it came with, and daylight savings can't make a change out of nothing
+#Everything the script writes gets the UTC offset that your time zone actually has at that moment (zoneinfo keeps the daylight savings changes
+#in memory, so that's cheap). That includes the hour that happens twice when the clocks go back, where the same time has two different offsets
+
+localZone = ZoneInfo(timezone)
+
+
+def toLocalTime(dateTimeValue):
+    if dateTimeValue.tzinfo == None: #a time without a time zone is taken to be in yours
+        return dateTimeValue.replace(tzinfo=localZone)
+    return dateTimeValue.astimezone(localZone)
+
+
+def formatWithOffset(dateTimeValue):
+    localTime = toLocalTime(dateTimeValue)
+    minutes = int(localTime.utcoffset().total_seconds() // 60) #uses fold, so the second 01:30 on the day the clocks go back gets the later offset
+    sign = '-' if minutes < 0 else '+'
+    return localTime.strftime("%Y-%m-%dT%H:%M:%S") + f'{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}'
+
+
+def notion_time():
+    return formatWithOffset(datetime.now(localZone))
+
+
+def DateTimeIntoNotionFormat(dateTimeValue):
+    return formatWithOffset(dateTimeValue)
+
+
+def googleQueryTime(dateTimeValue):
+    return formatWithOffset(dateTimeValue)
+
+
+######################################################################
+#METHOD TO QUERY THE NOTION DATABASE
+#Works just like notion.databases.query, except that only the properties we actually read get downloaded
+#and it keeps asking until all of the matching pages have come back (Notion only hands out 100 at a time)
+
+def queryNotionDatabase(properties=NOTION_QUERY_PROPERTIES, **query):
+    body = {key: value for key, value in query.items() if key != 'database_id'}
+    filterProperties = [notionPropertyIds[name] for name in properties]
+    results = []
+    while True:
+        response = callApi('Notion', lambda: notion.request(path='databases/' + query['database_id'] + '/query', method='POST', query={'filter_properties': filterProperties}, body=body))
+        results.extend(response['results'])
+        if not response.get('has_more'):
+            return {'results': results}
+        body['start_cursor'] = response['next_cursor']
+
+
+######################################################################
+#METHOD TO ARCHIVE A NOTION PAGE
+#The notion-client we use (0.4.0) only passes the properties on from pages.update, so asking it to archive a page quietly does nothing
+#That's why the request is sent by hand here, the same way queryNotionDatabase does it
+
+def archiveNotionPage(pageId, properties):
+    return notion.request(path='pages/' + pageId, method='PATCH', body={'properties': properties, 'archived': True})
+
+
+######################################################################
+#METHODS FOR THE SYNC WINDOW
+#A window is a (start, end) pair of datetimes. Events starting on or after the start and before the end get synced
+#The same window is used for the Notion queries and the GCal lists, so both sides always agree on what is being synced
+
+#--from and --to move either end of it for one run (--to is the last day that's included)
+
+def syncWindow():
+    today = datetime.combine(date.today(), datetime.min.time())
+    windowStart = args.windowStart if args.windowStart != None else today - timedelta(days=SYNC_PAST_DAYS)
+    windowEnd = args.windowEnd + timedelta(days=1) if args.windowEnd != None else today + timedelta(days=SYNC_FUTURE_DAYS + 1)
+    return windowStart, windowEnd
+
+
+def notionCalendarFilters():
+    #when only some calendars are synced (--calendar), the Notion queries only ask for the tasks on them
+    #A task with an empty Calendar select goes on DEFAULT_CALENDAR_NAME, so those come along when that one is picked
+    if args.calendars == None:
+        return []
+    calendarNames = calendarRegistry.syncedNames()
+    conditions = [{"property": Calendar_Notion_Name, "select": {"equals": name}} for name in calendarNames]
+    if DEFAULT_CALENDAR_NAME in calendarNames:
+        conditions.append({"property": Calendar_Notion_Name, "select": {"is_empty": True}})
+    return [{"or": conditions}]
+
+
+def notionWindowFilter(window):
+    windowStart, windowEnd = window
+    return {
+        "and": [
+            {
+                "property": Date_Notion_Name,
+                "date": {
+                    "on_or_after": windowStart.strftime("%Y-%m-%d")
+                }
+            },
+            {
+                "property": Date_Notion_Name,
+                "date": {
+                    "before": windowEnd.strftime("%Y-%m-%d")
+                }
+            }
+        ] + notionCalendarFilters()
+    }
+
+
+######################################################################
+#METHODS TO COMPARE A GCAL EVENT AGAINST THE LAST VERSION WE SAW
+#Every time GCal hands us an event (when we read it or after we change it), it goes into the gcalEventCache
+#That way an update only has to send the fields that are actually different instead of the whole event
+
+def getGCalEvent(threadService, calendarId, eventId):
+    #If we've seen the event before, we tell GCal which version we have (the etag). If it's still the same, GCal answers 
+    #with a "304 Not Modified" and no event at all, so there's nothing to download or read through
+    cachedEvent = gcalEventCache.get(calendarId, eventId)
+    request = threadService.events().get(calendarId=calendarId, eventId=eventId, fields=GCAL_EVENT_FIELDS)
+    if cachedEvent != None:
+        request.headers['If-None-Match'] = cachedEvent['etag']
+    try:
+        event = callApi('GCal', request.execute)
+    except HttpError as e:
+        if e.resp.status == 304 and cachedEvent != None:
+            return cachedEvent
+        raise
+    gcalEventCache.put(calendarId, event)
+    return event
+
+
+def sameEventTime(newTime, oldTime):
+    #GCal hands back dateTimes with the UTC offset attached (2021-06-01T08:00:00-04:00) while we send them in your time zone without it,
+    #so we compare the actual moments in time. An all-day event has to stay an all-day event to be the same
+    if 'date' in newTime:
+        return oldTime.get('date') == newTime['date']
+    if 'dateTime' not in oldTime:
+        return False
+    return parseGCalTime(newTime, isEnd=False) == parseGCalTime(oldTime, isEnd=False)
+
+
+def findEventChanges(event, lastKnownEvent):
+    if lastKnownEvent == None: #we've never seen this event, so everything has to be sent
+        return event
+
+    changes = {}
+    for key in ['summary', 'description']:
+        if event[key] != lastKnownEvent.get(key, ''): #GCal leaves out the description if it is empty
+            changes[key] = event[key]
+
+    for key in ['start', 'end']:
+        if not sameEventTime(event[key], lastKnownEvent.get(key, {})):
+            changes[key] = dict(event[key])
+            #a patch gets merged into what GCal already has, so switching between all-day and timed events has to clear the other one
+            if 'date' in event[key]:
+                changes[key]['dateTime'] = None
+            else:
+                changes[key]['date'] = None
+
+    if event['source'] != lastKnownEvent.get('source'):
+        changes['source'] = event['source']
+
+    return changes
+
+
+######################################################################
+#METHOD TO PUT A START AND END TIME INTO NOTION'S DATE FORMAT
+
+def makeNotionDate(start, end):
+    if start.hour == 0 and start.minute == 0 and start == end: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
+        return {"date": {'start': start.strftime("%Y-%m-%d"), 'end': None}}
+    elif start.hour == 0 and start.minute == 0 and end.hour == 0 and end.minute == 0: #both are 12 am so it's a multiple day event, still in date format
+        return {"date": {'start': start.strftime("%Y-%m-%d"), 'end': end.strftime("%Y-%m-%d")}}
+    else: #update Notion using datetime format
+        return {"date": {'start': DateTimeIntoNotionFormat(start), 'end': DateTimeIntoNotionFormat(end)}}
+
+
 ######################################################################
 #METHOD TO MAKE A CALENDAR EVENT DESCRIPTION
 
@@ -168,1406 +1310,2186 @@ def makeTaskURL(ending, urlRoot):
 
 
 ######################################################################
-#METHOD TO MAKE A CALENDAR EVENT
+#METHOD TO TURN A NOTION DATE INTO A DATETIME
+#Notion gives back either just a date (2021-06-01) or a date and time with the UTC offset on the end (2021-06-01T08:00:00.000-04:00)
 
+def parseNotionDate(value):
+    if len(value) == 10: #just a date
+        return toLocalTime(datetime.strptime(value, "%Y-%m-%d"))
+    return toLocalTime(datetime.fromisoformat(value.replace('Z', '+00:00')))
+
+
+######################################################################
+#METHOD TO TURN A GCAL START OR END INTO A DATETIME
+#All-day events only have a date, and their end is 12 AM of the day after the event, so for an end we take that day back off
+#Timed events come with the UTC offset of whatever time zone the event was made in, so they get moved over into yours
+
+def parseGCalTime(timeValue, isEnd):
+    if 'dateTime' in timeValue:
+        return toLocalTime(datetime.fromisoformat(timeValue['dateTime'].replace('Z', '+00:00')))
+    x = toLocalTime(datetime.strptime(timeValue['date'], "%Y-%m-%d"))
+    if isEnd:
+        x = x - timedelta(days=1)
+    return x
+
+
+######################################################################
+#METHOD TO MAKE THE BODY OF A CALENDAR EVENT
+#This is what gets sent to GCal, both when an event is made and when it is updated
+
+
+def makeEventBody(eventName, eventDescription, eventStartTime, sourceURL, eventEndTime):
 
-def makeCalEvent(eventName, eventDescription, eventStartTime, sourceURL, eventEndTime, calId):
- 
     if eventStartTime.hour == 0 and eventStartTime.minute == 0 and eventEndTime == eventStartTime: #only startTime is given from the Notion Dashboard
         if AllDayEventOption == 1:
             eventStartTime = datetime.combine(eventStartTime, datetime.min.time()) + timedelta(hours=DEFAULT_EVENT_START) ##make the events pop up at 8 am instead of 12 am
             eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH)
-            event = {
-                'summary': eventName,
-                'description': eventDescription,
-                'start': {
-                    'dateTime': eventStartTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                    'timeZone': timezone,
-                },
-                'end': {
-                    'dateTime': eventEndTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                    'timeZone': timezone,
-                }, 
-                'source': {
-                    'title': 'Notion Link',
-                    'url': sourceURL,
-                }
-            }
+            allDay = False
         else:
             eventEndTime = eventEndTime + timedelta(days=1) #gotta make it to 12AM the day after
-            event = {
-                'summary': eventName,
-                'description': eventDescription,
-                'start': {
-                    'date': eventStartTime.strftime("%Y-%m-%d"),
-                    'timeZone': timezone,
-                },
-                'end': {
-                    'date': eventEndTime.strftime("%Y-%m-%d"),
-                    'timeZone': timezone,
-                }, 
-                'source': {
-                    'title': 'Notion Link',
-                    'url': sourceURL,
-                }
-            }
-    elif eventStartTime.hour == 0 and eventStartTime.minute ==  0 and eventEndTime.hour == 0 and eventEndTime.minute == 0 and eventStartTime != eventEndTime:
-        
+            allDay = True
+    elif eventStartTime.hour == 0 and eventStartTime.minute ==  0 and eventEndTime.hour == 0 and eventEndTime.minute == 0 and eventStartTime != eventEndTime: #it's a multiple day event
         eventEndTime = eventEndTime + timedelta(days=1) #gotta make it to 12AM the day after
-        
-        event = {
-            'summary': eventName,
-            'description': eventDescription,
-            'start': {
-                'date': eventStartTime.strftime("%Y-%m-%d"),
-                'timeZone': timezone,
-            },
-            'end': {
-                'date': eventEndTime.strftime("%Y-%m-%d"),
-                'timeZone': timezone,
-            }, 
-            'source': {
-                'title': 'Notion Link',
-                'url': sourceURL,
-            }
-        }
-    
+        allDay = True
     else: #just 2 datetimes passed in from the method call that are not at 12 AM
-        if eventStartTime.hour == 0 and eventStartTime.minute == 0 and eventEndTime != eventStartTime: #Start on Notion is 12 am and end is also given on Notion 
+        if eventStartTime.hour == 0 and eventStartTime.minute == 0 and eventEndTime != eventStartTime: #Start on Notion is 12 am and end is also given on Notion
             eventStartTime = eventStartTime #start will be 12 am
             eventEndTime = eventEndTime #end will be whenever specified
         elif eventStartTime.hour == 0 and eventStartTime.minute == 0: #if the datetime fed into this is only a date or is at 12 AM, then the event will fall under here
             eventStartTime = datetime.combine(eventStartTime, datetime.min.time()) + timedelta(hours=DEFAULT_EVENT_START) ##make the events pop up at 8 am instead of 12 am
-            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH)  
-        elif eventEndTime == eventStartTime: #this would meant that only 1 datetime was actually on the notion dashboard 
+            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH)
+        elif eventEndTime == eventStartTime: #this would meant that only 1 datetime was actually on the notion dashboard
             eventStartTime = eventStartTime
-            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH) 
+            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH)
         else: #if you give a specific start time to the event
             eventStartTime = eventStartTime
             eventEndTime = eventEndTime
-        
-        event = {
-            'summary': eventName,
-            'description': eventDescription,
-            'start': {
-                'dateTime': eventStartTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                'timeZone': timezone,
-            },
-            'end': {
-                'dateTime': eventEndTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                'timeZone': timezone,
-            }, 
-            'source': {
-                'title': 'Notion Link',
-                'url': sourceURL,
-            }
-        }    
-    print('Adding this event to calendar: ', eventName)
+        allDay = False
 
-    print(event)
-    x = service.events().insert(calendarId=calId, body=event).execute()
-    return x['id']
+    if allDay:
+        start = {'date': eventStartTime.strftime("%Y-%m-%d"), 'timeZone': timezone}
+        end = {'date': eventEndTime.strftime("%Y-%m-%d"), 'timeZone': timezone}
+    else:
+        start = {'dateTime': eventStartTime.strftime("%Y-%m-%dT%H:%M:%S"), 'timeZone': timezone}
+        end = {'dateTime': eventEndTime.strftime("%Y-%m-%dT%H:%M:%S"), 'timeZone': timezone}
+
+    return {
+        'summary': eventName,
+        'description': eventDescription,
+        'start': start,
+        'end': end,
+        'source': {
+            'title': 'Notion Link',
+            'url': sourceURL,
+        }
+    }
 
 
 ######################################################################
-#METHOD TO UPDATE A CALENDAR EVENT
+#METHOD TO PICK THE GCAL EVENT ID FOR A NOTION PAGE
+#GCal lets us choose the id of a new event as long as it only uses 0-9 and a-v. A Notion page id without the dashes fits that,
+#so every page always maps to the same event id and a run that gets cut off and redone can't make a second event
 
-def upDateCalEvent(eventName, eventDescription, eventStartTime, sourceURL, eventId, eventEndTime, currentCalId, CalId):
+def makeGCalEventId(pageId):
+    return pageId.replace('-', '')
 
-    if eventStartTime.hour == 0 and eventStartTime.minute == 0 and eventEndTime == eventStartTime:  #you're given a single date
-        if AllDayEventOption == 1:
-            eventStartTime = datetime.combine(eventStartTime, datetime.min.time()) + timedelta(hours=DEFAULT_EVENT_START) ##make the events pop up at 8 am instead of 12 am
-            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH)
-            event = {
-                'summary': eventName,
-                'description': eventDescription,
-                'start': {
-                    'dateTime': eventStartTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                    'timeZone': timezone,
+
+######################################################################
+#METHODS TO MAKE THE PROPERTIES OF A NOTION PAGE FOR A GCAL EVENT
+
+def makeNotionPageProperties(eventName, notionDate, description, eventId, calendarId, calendarName):
+    return {
+        Task_Notion_Name: {
+            "type": 'title',
+            "title": [
+            {
+                "type": 'text',
+                "text": {
+                "content": eventName,
                 },
-                'end': {
-                    'dateTime': eventEndTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                    'timeZone': timezone,
-                }, 
-                'source': {
-                    'title': 'Notion Link',
-                    'url': sourceURL,
-                }
+            },
+            ],
+        },
+        Date_Notion_Name: {
+            "type": 'date',
+            'date': notionDate,
+        },
+        LastUpdatedTime_Notion_Name: {
+            "type": 'date',
+            'date': {
+                'start': notion_time(),
+                'end': None,
             }
-        else:
-            eventEndTime = eventEndTime + timedelta(days=1) #gotta make it to 12AM the day after
-            event = {
-                'summary': eventName,
-                'description': eventDescription,
-                'start': {
-                    'date': eventStartTime.strftime("%Y-%m-%d"),
-                    'timeZone': timezone,
-                },
-                'end': {
-                    'date': eventEndTime.strftime("%Y-%m-%d"),
-                    'timeZone': timezone,
-                }, 
-                'source': {
-                    'title': 'Notion Link',
-                    'url': sourceURL,
+        },
+        ExtraInfo_Notion_Name:  {
+            "type": 'rich_text',
+            "rich_text": [{
+                'text': {
+                    'content': description
                 }
-            }
-    elif eventStartTime.hour == 0 and eventStartTime.minute ==  0 and eventEndTime.hour == 0 and eventEndTime.minute == 0 and eventStartTime != eventEndTime: #it's a multiple day event
-        
-        eventEndTime = eventEndTime + timedelta(days=1) #gotta make it to 12AM the day after
-        
-        event = {
-            'summary': eventName,
-            'description': eventDescription,
-            'start': {
-                'date': eventStartTime.strftime("%Y-%m-%d"),
-                'timeZone': timezone,
+            }]
+        },
+        GCalEventId_Notion_Name: {
+            "type": "rich_text",
+            "rich_text": [{
+                'text': {
+                    'content': eventId
+                }
+            }]
+        },
+        On_GCal_Notion_Name: {
+            "type": "checkbox",
+            "checkbox": True
+        },
+        Current_Calendar_Id_Notion_Name: {
+            "rich_text": [{
+                'text': {
+                    'content': calendarId
+                }
+            }]
+        },
+        Calendar_Notion_Name:  {
+            'select': {
+                "name": calendarName
             },
-            'end': {
-                'date': eventEndTime.strftime("%Y-%m-%d"),
-                'timeZone': timezone,
-            }, 
-            'source': {
-                'title': 'Notion Link',
-                'url': sourceURL,
-            }
         }
-    
-    else: #just 2 datetimes passed in 
-        if eventStartTime.hour == 0 and eventStartTime.minute == 0 and eventEndTime != eventStartTime: #Start on Notion is 12 am and end is also given on Notion 
-            eventStartTime = eventStartTime #start will be 12 am
-            eventEndTime = eventEndTime #end will be whenever specified
-        elif eventStartTime.hour == 0 and eventStartTime.minute == 0: #if the datetime fed into this is only a date or is at 12 AM, then the event will fall under here
-            eventStartTime = datetime.combine(eventStartTime, datetime.min.time()) + timedelta(hours=DEFAULT_EVENT_START) ##make the events pop up at 8 am instead of 12 am
-            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH)  
-        elif eventEndTime == eventStartTime: #this would meant that only 1 datetime was actually on the notion dashboard 
-            eventStartTime = eventStartTime
-            eventEndTime = eventStartTime + timedelta(minutes= DEFAULT_EVENT_LENGTH) 
-        else: #if you give a specific start time to the event
-            eventStartTime = eventStartTime
-            eventEndTime = eventEndTime 
-        event = {
-            'summary': eventName,
-            'description': eventDescription,
-            'start': {
-                'dateTime': eventStartTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                'timeZone': timezone,
-            },
-            'end': {
-                'dateTime': eventEndTime.strftime("%Y-%m-%dT%H:%M:%S"),
-                'timeZone': timezone,
-            }, 
-            'source': {
-                'title': 'Notion Link',
-                'url': sourceURL,
-            }
-        }    
-    print('Updating this event to calendar: ', eventName)
+    }
 
-    if currentCalId == CalId:
-        x = service.events().update(calendarId=CalId, eventId = eventId, body=event).execute()
 
-    else: #When we have to move the event to a new calendar. We must move the event over to the new calendar and then update the information on the event
-        print('Event ' + eventId)
-        print('CurrentCal ' + currentCalId)
-        print('NewCal ' + CalId)
-        x= service.events().move(calendarId= currentCalId , eventId= eventId, destination=CalId).execute()
-        print('New event id: ' + x['id'])
-        x = service.events().update(calendarId=CalId, eventId = eventId, body=event).execute()
+def makeNotionPageForEvent(item, calendarId):
+    calStartDate = parseGCalTime(item['start'], isEnd=False)
+    calEndDate = parseGCalTime(item['end'], isEnd=False)
 
-    return x['id']
+    if calStartDate == calEndDate - timedelta(days=1): #only add in the start DATE
+        notionDate = {'start': calStartDate.strftime("%Y-%m-%d"), 'end': None}
+    elif calStartDate.hour == 0 and calStartDate.minute == 0 and calEndDate.hour == 0 and calEndDate.minute == 0: #add start and end in DATE format
+        notionDate = {'start': calStartDate.strftime("%Y-%m-%d"), 'end': (calEndDate - timedelta(days=1)).strftime("%Y-%m-%d")}
+    else: #regular datetime stuff
+        notionDate = {'start': DateTimeIntoNotionFormat(calStartDate), 'end': DateTimeIntoNotionFormat(calEndDate)}
 
+    return makeNotionPageProperties(item.get('summary', ''), notionDate, item.get('description', ' '), item['id'], calendarId, calendarRegistry.nameOf[calendarId])
 
 
 
-###########################################################################
-##### Part 1: Take Notion Events not on GCal and move them over to GCal
-###########################################################################
 
+######################################################################
+#METHODS FOR RECURRING EVENTS
+#GCal lists a recurring event once (the series, with its RRULE/EXDATE lines) plus a separate event for every single time of it that was changed or cancelled
+#Instead of asking GCal for every time the event happens (a daily standup is 365 events a year, on every run), the series is kept in the gcalEventCache
+#and its times inside the sync window are worked out here. Each one gets the id GCal gives it too ({seriesId}_{start time}), so it can be read, updated
+#and deleted on GCal just like any other event
+
+def makeInstance(series, idEnding, start, end):
+    return {
+        'id': series['id'] + '_' + idEnding,
+        'summary': series.get('summary', ''),
+        'description': series.get('description', ''),
+        'start': start,
+        'end': end,
+        'organizer': series['organizer'],
+        'status': 'confirmed',
+        'recurringEventId': series['id'],
+        'originalStartTime': start,
+    }
 
-## Note that we are only querying for events that are today or in the next week so the code can be efficient. 
-## If you just want all Notion events to be on GCal, then you'll have to edit the query so it is only checking the 'On GCal?' property
 
+@lru_cache(maxsize=1024)
+def expandSeries(calendarId, seriesId, etag, windowStart, windowEnd):
+    #the etag is part of what gets remembered, so a series that was changed on GCal gets worked out again
+    series = gcalEventCache.get(calendarId, seriesId)
+    recurrence = '\n'.join(series['recurrence'])
+    instances = []
+
+    if 'date' in series['start']: #all-day events
+        seriesStart = datetime.strptime(series['start']['date'], "%Y-%m-%d")
+        length = datetime.strptime(series['end']['date'], "%Y-%m-%d") - seriesStart
+        rule = rrulestr(recurrence, dtstart=seriesStart, forceset=True)
+        for instanceStart in rule.between(windowStart.replace(tzinfo=None) - length, windowEnd.replace(tzinfo=None), inc=True):
+            instances.append(makeInstance(series, instanceStart.strftime("%Y%m%d"), {'date': instanceStart.strftime("%Y-%m-%d")}, {'date': (instanceStart + length).strftime("%Y-%m-%d")}))
+
+    else: #the times are worked out in the series' own time zone, so daylight savings moves them the same way it does on GCal
+        seriesZone = ZoneInfo(series['start'].get('timeZone', timezone))
+        seriesStart = datetime.fromisoformat(series['start']['dateTime'].replace('Z', '+00:00')).astimezone(seriesZone)
+        length = datetime.fromisoformat(series['end']['dateTime'].replace('Z', '+00:00')) - seriesStart
+        rule = rrulestr(recurrence, dtstart=seriesStart, forceset=True)
+        for instanceStart in rule.between(windowStart - length, windowEnd, inc=True):
+            instanceId = instanceStart.astimezone(ZoneInfo('UTC')).strftime("%Y%m%dT%H%M%SZ")
+            instances.append(makeInstance(series, instanceId, {'dateTime': instanceStart.isoformat(), 'timeZone': seriesZone.key}, {'dateTime': (instanceStart + length).isoformat(), 'timeZone': seriesZone.key}))
+
+    return tuple(instances)
+
+
+def expandRecurringEvents(threadService, calendarId, items, window):
+    #turns what GCal listed into one event for every time something happens in the window
+    windowStart, windowEnd = toLocalTime(window[0]), toLocalTime(window[1])
+    changedInstances = {item['id'] for item in items if 'recurringEventId' in item} #these come from GCal as they are, so they aren't worked out from the series
+    events = []
+    for item in items:
+        if item['status'] == 'cancelled': #deleted events and cancelled times of a recurring event
+            continue
+        if 'recurrence' not in item: #regular events and changed times of a recurring event
+            events.append(item)
+            continue
+        try:
+            instances = expandSeries(calendarId, item['id'], item['etag'], windowStart, windowEnd)
+        except Exception as e: #a recurrence we can't work out here, so GCal has to do it
+            print('Asking GCal for the times of ' + item.get('summary', item['id']) + ' (' + str(e) + ')')
+            instances = callApi('GCal', threadService.events().instances(calendarId=calendarId, eventId=item['id'], timeMin=googleQueryTime(windowStart), timeMax=googleQueryTime(windowEnd), maxResults=2500, fields=GCAL_LIST_FIELDS).execute)['items']
+        events.extend(instance for instance in instances if instance['id'] not in changedInstances)
+    return events
 
-todayDate = datetime.today().strftime("%Y-%m-%d")
 
-my_page = notion.databases.query(  #this query will return a dictionary that we will parse for information that we want
-    **{
-        "database_id": database_id, 
-        "filter": {
-            "and": [
-                {
-                    "property": On_GCal_Notion_Name, 
-                    "checkbox":  {
-                        "equals": False
-                    }
-                }, 
-                {
-                    "or": [
-                    {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "equals": todayDate
-                        }
-                    }, 
-                    {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "next_week": {}
-                        }
-                    }
-                ]   
-                },
-                {
-                    "property": Delete_Notion_Name, 
-                    "checkbox":  {
-                        "equals": False
-                    }
-                }
-            ]
-        },
-    }
-)
-resultList = my_page['results']
 
-# print(len(resultList))
+######################################################################
+#METHODS FOR THE PRIORITY TIERS
+
+def tierEnds():
+    #where each tier ends (None = the end of the sync window)
+    today = datetime.combine(date.today(), datetime.min.time())
+    return {tierName: (today + timedelta(days=tier['days'] + 1) if tier['days'] != None else None) for tierName, tier in SYNC_TIERS.items()}
+
+
+def eventTier(startTime):
+    #an event without a date, or one that started before today (e.g. in a backfill), goes in the last tier
+    tierNames = list(SYNC_TIERS.keys())
+    today = datetime.combine(date.today(), datetime.min.time())
+    if startTime == None or toLocalTime(startTime) < toLocalTime(today):
+        return tierNames[-1]
+    for tierName, tierEnd in tierEnds().items():
+        if tierEnd == None or toLocalTime(startTime) < toLocalTime(tierEnd):
+            return tierName
+    return tierNames[-1]
+
+
+def tierRank(tierName):
+    return list(SYNC_TIERS.keys()).index(tierName)
+
+
+def tierWindow(tierNames, window):
+    #the part of the window that the given tiers cover together
+    #The days before today belong to the last tier, so once that one is in, the window goes all the way back to its start
+    windowStart, windowEnd = window
+    ends = tierEnds()
+    allTiers = list(SYNC_TIERS.keys())
+    first = min(tierRank(tierName) for tierName in tierNames)
+    last = max(tierRank(tierName) for tierName in tierNames)
+    if last == len(allTiers) - 1:
+        start = windowStart
+    elif first == 0:
+        start = max(windowStart, datetime.combine(date.today(), datetime.min.time()))
+    else:
+        start = max(windowStart, ends[allTiers[first - 1]])
+    end = windowEnd if ends[allTiers[last]] == None else min(windowEnd, ends[allTiers[last]])
+    return start, max(start, end)
 
-try:
-    print(resultList[0])
-except:
-    print('')
 
-TaskNames = []
-start_Dates = []
-end_Times = []
-Initiatives = []
-ExtraInfo = []
-URL_list = []
-calEventIdList = []
-CalendarList = []
 
-if len(resultList) > 0:
+######################################################################
+#METHODS FOR FINDING CLASHES AND FREE TIME
+#The timed events on a calendar go into an IntervalIndex, which can tell which of them overlap a stretch of time without going through all of them
+#That's what the conflicts report and FIND_FREE_SLOTS are built on. All-day events don't take up any particular time, so they're left out
+
+class IntervalIndex:
+    #An interval tree kept in arrays: the intervals are sorted by start, and maxEnd holds the latest end under each node of a balanced tree over them
+    #(node 1 is the root and node n's children are 2n and 2n+1), so a search skips every part of the tree that ends before the time it's looking at
+    #Finding what overlaps takes O(log n) plus one step for each interval found. Intervals added later sit in a short list until it's worth rebuilding
+    def __init__(self, intervals=()):
+        self.intervals = sorted(intervals, key=lambda interval: interval[0]) #(start timestamp, end timestamp, event)
+        self.added = []
+        self.build()
+
+    def build(self):
+        self.starts = [interval[0] for interval in self.intervals]
+        self.size = 1
+        while self.size < len(self.intervals):
+            self.size *= 2
+        self.maxEnd = [-math.inf] * (2 * self.size)
+        for i, interval in enumerate(self.intervals):
+            self.maxEnd[self.size + i] = interval[1]
+        for node in range(self.size - 1, 0, -1):
+            self.maxEnd[node] = max(self.maxEnd[2 * node], self.maxEnd[2 * node + 1])
+
+    def add(self, start, end, event):
+        self.added.append((start, end, event))
+        if len(self.added) > 64 + math.isqrt(len(self.intervals)):
+            self.intervals = sorted(self.intervals + self.added, key=lambda interval: interval[0])
+            self.added = []
+            self.build()
+
+    def overlapping(self, start, end):
+        #every interval that starts before end and ends after start
+        found = [interval for interval in self.added if interval[0] < end and interval[1] > start]
+        count = bisect.bisect_left(self.starts, end) #only the first count intervals start before end
+        stack = [(1, 0, self.size)]
+        while len(stack) > 0:
+            node, lo, hi = stack.pop()
+            if lo >= count or self.maxEnd[node] <= start:
+                continue
+            if hi - lo == 1:
+                found.append(self.intervals[lo])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return found
+
+    def conflicts(self):
+        #every pair of intervals that overlap, each pair once
+        pairs = []
+        for interval in self.intervals + self.added:
+            for other in self.overlapping(interval[0], interval[1]):
+                if (other[0], other[2]['id']) > (interval[0], interval[2]['id']):
+                    pairs.append((interval, other))
+        return pairs
+
+    def firstFreeSlot(self, fromTime, untilTime, length):
+        #the earliest start from fromTime on where length seconds fit in before untilTime without overlapping anything (None if there isn't one)
+        slotStart = fromTime
+        while slotStart + length <= untilTime:
+            overlaps = self.overlapping(slotStart, slotStart + length)
+            if len(overlaps) == 0:
+                return slotStart
+            slotStart = max(interval[1] for interval in overlaps)
+        return None
+
+
+def buildCalendarIndexes(window):
+    #calendar id -> an IntervalIndex of the timed events on it inside the window
+    calendarNames = calendarRegistry.syncedNames()
+    indexes = {}
+    for calendarName, events in zip(calendarNames, fanOutCalendarReads(listCalendarEvents, [(calendarName, window) for calendarName in calendarNames])):
+        indexes[calendarRegistry.idOf[calendarName]] = IntervalIndex(
+            (parseGCalTime(event['start'], isEnd=False).timestamp(), parseGCalTime(event['end'], isEnd=True).timestamp(), event)
+            for event in events if 'dateTime' in event['start']
+        )
+    return indexes
 
-    for i, el in enumerate(resultList):
-        print('\n')
-        print(el)
-        print('\n')
 
-        TaskNames.append(el['properties'][Task_Notion_Name]['title'][0]['text']['content'])
-        start_Dates.append(el['properties'][Date_Notion_Name]['date']['start'])
+def findFreeSlot(index, day, eventId, eventName):
+    #returns the start of the first free DEFAULT_EVENT_LENGTH long gap on that day between DEFAULT_EVENT_START and LATEST_DEFAULT_END, and marks it as taken
+    dayStart = toLocalTime(datetime.combine(day.date(), datetime.min.time()))
+    length = DEFAULT_EVENT_LENGTH * 60
+    slotStart = index.firstFreeSlot((dayStart + timedelta(hours=DEFAULT_EVENT_START)).timestamp(), (dayStart + timedelta(hours=LATEST_DEFAULT_END)).timestamp(), length)
+    if slotStart == None:
+        return None
+    index.add(slotStart, slotStart + length, {'id': eventId, 'summary': eventName}) #so the next task on that day doesn't get the same gap
+    return datetime.fromtimestamp(slotStart, localZone)
 
-        if el['properties'][Date_Notion_Name]['date']['end'] != None:
-            end_Times.append(el['properties'][Date_Notion_Name]['date']['end'])
-        else:
-            end_Times.append(el['properties'][Date_Notion_Name]['date']['start'])
 
-        try:
-            Initiatives.append(el['properties'][Initiative_Notion_Name]['select']['name'])
-        except:
-            Initiatives.append("")
-        
-        try: 
-            ExtraInfo.append(el['properties'][ExtraInfo_Notion_Name]['rich_text'][0]['text']['content'])
-        except:
-            ExtraInfo.append("")
-        URL_list.append(makeTaskURL(el['id'], urlRoot))
-        
-        try:
-            CalendarList.append(calendarDictionary[el['properties'][Calendar_Notion_Name]['select']['name']])
-        except: #keyerror occurs when there's nothing put into the calendar in the first place
-            CalendarList.append(calendarDictionary[DEFAULT_CALENDAR_NAME])
+def printConflicts(window):
+    for calendarId, index in buildCalendarIndexes(window).items():
+        pairs = index.conflicts()
+        print(f'{len(pairs)} clashes on {calendarId}')
+        for first, second in pairs:
+            print(f"  {datetime.fromtimestamp(first[0], localZone):%Y-%m-%d %H:%M}-{datetime.fromtimestamp(first[1], localZone):%H:%M} {first[2].get('summary', '')}"
+                f"  overlaps  {datetime.fromtimestamp(second[0], localZone):%H:%M}-{datetime.fromtimestamp(second[1], localZone):%H:%M} {second[2].get('summary', '')}")
 
-        pageId = el['id']
-        my_page = notion.pages.update( ##### This checks off that the event has been put on Google Calendar
-            **{
-                "page_id": pageId, 
-                "properties": {
-                    On_GCal_Notion_Name: {
-                        "checkbox": True 
-                    },
-                    LastUpdatedTime_Notion_Name: {
-                        "date":{
-                            'start': notion_time(),
-                            'end': None,
-                        }
-                    }, 
-                },
-            },
-        )  
-        print(CalendarList)
-        
 
-        # 2 Cases: Start and End are  both either date or date+time #Have restriction that the calendar events don't cross days
-        try:
-            #start and end are both dates
-            calEventId = makeCalEvent(TaskNames[i], makeEventDescription(Initiatives[i], ExtraInfo[i]), datetime.strptime(start_Dates[i], '%Y-%m-%d'), URL_list[i], datetime.strptime(end_Times[i], '%Y-%m-%d'), CalendarList[i] )
-        except:
-            try:
-                #start and end are both date+time
-                calEventId = makeCalEvent(TaskNames[i], makeEventDescription(Initiatives[i], ExtraInfo[i]), datetime.strptime(start_Dates[i][:-6], "%Y-%m-%dT%H:%M:%S.000"), URL_list[i],  datetime.strptime(end_Times[i][:-6], "%Y-%m-%dT%H:%M:%S.000"), CalendarList[i])
-            except:
-                calEventId = makeCalEvent(TaskNames[i], makeEventDescription(Initiatives[i], ExtraInfo[i]), datetime.strptime(start_Dates[i][:-6], "%Y-%m-%dT%H:%M:%S.%f"), URL_list[i],  datetime.strptime(end_Times[i][:-6], "%Y-%m-%dT%H:%M:%S.%f"), CalendarList[i])
-
-
-        
-        calEventIdList.append(calEventId)
-
-        if CalendarList[i] == calendarDictionary[DEFAULT_CALENDAR_NAME]: #this means that there is no calendar assigned on Notion
-            my_page = notion.pages.update( ##### This puts the the GCal Id into the Notion Dashboard
-                **{
-                    "page_id": pageId, 
-                    "properties": {
-                        GCalEventId_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': calEventIdList[i]
-                                }
-                            }]
-                        },
-                        Current_Calendar_Id_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': CalendarList[i]
-                                }
-                            }]
-                        },
-                        Calendar_Notion_Name:  { 
-                            'select': {
-                                "name": DEFAULT_CALENDAR_NAME
-                            },
-                        },
-                    },
-                },
-            )
-        else: #just a regular update
-            my_page = notion.pages.update(
-                **{
-                    "page_id": pageId, 
-                    "properties": {
-                        GCalEventId_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': calEventIdList[i]
-                                }
-                            }]
-                        },
-                        Current_Calendar_Id_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': CalendarList[i]
-                                }
-                            }]
-                        }
-                    },
-                },
-            )
 
+###########################################################################
+##### The Sync Plan
+###########################################################################
 
+#Parts 1-5 don't change anything themselves. They read both sides and write down every change that needs to be made as an action in the plan
+#Once everything has been read, the plan gets cleaned up (see optimizePlan) and then carried out in bulk (see executePlan)
+#Running the script with --dry-run just prints the plan instead of carrying it out
+
+GCAL_ACTION_KINDS = ('create_gcal', 'patch_gcal', 'move_gcal', 'delete_gcal')
+NOTION_ACTION_KINDS = ('create_page', 'update_page')
+
+
+@dataclass
+class SyncAction:
+    id: int
+    kind: str #one of GCAL_ACTION_KINDS or NOTION_ACTION_KINDS
+    description: str #what gets printed when the action runs (or in the --dry-run output)
+    after: list = field(default_factory=list) #ids of the actions that have to go through before this one can run
+    pageId: str = None
+    eventId: str = None
+    calendarId: str = None #the calendar the event is on (or is going to be made on)
+    destinationId: str = None #the calendar the event is being moved to
+    body: dict = None #the GCal event, or only the changed fields of it for a patch
+    properties: dict = None #the Notion properties to write
+    archived: bool = False #archive the Notion page
+    linkEventId: str = None #write the id this event ended up with into the page's GCal Event Id
+    tier: str = None #which of the SYNC_TIERS the event is in (see eventTier)
+
+
+class SyncPlan:
+    def __init__(self):
+        self.actions = []
+        self.plannedEventIds = set() #ids of the GCal events this plan is going to make
+        self.changesFound = Counter() #(phase, tier) -> how many actions that phase added to the plan for that tier
+        self.readCost = {} #phase -> how many calls to each API it took to plan it (the reads, before anything gets changed)
+
+    def add(self, kind, description, after=(), **details):
+        action = SyncAction(id=len(self.actions), kind=kind, description=description, after=[a.id for a in after], **details)
+        self.actions.append(action)
+        if kind == 'create_gcal':
+            self.plannedEventIds.add(action.eventId)
+        return action
+
+    def toJson(self):
+        return json.dumps([asdict(action) for action in self.actions], indent=2)
 
-else:
-    print("Nothing new added to GCal")
 
+######################################################################
+#METHOD TO CLEAN UP THE PLAN BEFORE IT RUNS
+#Drops the actions that would be wasted calls:
+# - an event that's going to be deleted doesn't need to be updated or moved first
+# - several updates to the same Notion page get folded into one update
+
+def optimizePlan(plan):
+    deletedEvents = {action.eventId for action in plan.actions if action.kind == 'delete_gcal'}
+    lastPageUpdate = {action.pageId: action for action in plan.actions if action.kind == 'update_page'}
+    replacedBy = {} #id of a dropped action -> id of the action that does its job now (None if nothing does)
+    earlierUpdates = {} #page id -> the updates to that page that get folded into its last one
+    kept = []
+
+    for action in plan.actions:
+        if action.kind in ('patch_gcal', 'move_gcal') and action.eventId in deletedEvents:
+            print('Skipping because the event gets deleted anyway: ' + action.description)
+            replacedBy[action.id] = None
+        elif action.kind == 'update_page' and lastPageUpdate[action.pageId] is not action:
+            earlierUpdates.setdefault(action.pageId, []).append(action)
+            replacedBy[action.id] = lastPageUpdate[action.pageId].id
+        else:
+            if action.kind == 'update_page' and action.pageId in earlierUpdates:
+                folded = earlierUpdates[action.pageId] + [action]
+                properties = {}
+                for update in folded:
+                    properties.update(update.properties) #the later values win
+                action.properties = properties
+                action.archived = any(update.archived for update in folded)
+                action.linkEventId = next((update.linkEventId for update in folded if update.linkEventId != None), None)
+                action.after = [actionId for update in folded for actionId in update.after]
+                action.description = ' + '.join(update.description for update in folded)
+                action.tier = min((update.tier for update in folded), key=tierRank)
+            kept.append(action)
+
+    #point anything that was waiting on a dropped action at whatever replaced it
+    for action in kept:
+        after = set()
+        for actionId in action.after:
+            while replacedBy.get(actionId) != None:
+                actionId = replacedBy[actionId]
+            if actionId not in replacedBy and actionId != action.id:
+                after.add(actionId)
+        action.after = sorted(after)
+
+    plan.actions = kept
 
 
-###########################################################################
-##### Part 2: Updating GCal Events that Need To Be Updated (Changed on Notion but need to be changed on GCal)
-###########################################################################
+######################################################################
+#METHOD TO SPLIT THE PLAN INTO WAVES
+#An action goes in the wave right after the last of the actions it waits on, so everything in one wave can be sent at the same time
+#(the plan is always built so that an action comes after the ones it waits on)
 
+def splitIntoWaves(actions):
+    waveOf = {}
+    waves = []
+    for action in actions:
+        waveOf[action.id] = max([waveOf[actionId] + 1 for actionId in action.after if actionId in waveOf], default=0)
+        while len(waves) <= waveOf[action.id]:
+            waves.append([])
+        waves[waveOf[action.id]].append(action)
+    return waves
 
-#Just gotta put a fail-safe in here in case people deleted the Calendar Variable
-#this queries items in the next week where the Calendar select thing is empty
-my_page = notion.databases.query(  
-    **{
-        "database_id": database_id, 
-        "filter": {
-            "and": [
-                {
-                    "property": Calendar_Notion_Name, 
-                    "select":  {
-                        "is_empty": True
-                    }
-                }, 
-                {
-                    "or": [
-                    {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "equals": todayDate
-                        }
-                    }, 
-                    {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "next_week": {}
-                        }
-                    }
-                ]   
-                },
-                {
-                    "property": Delete_Notion_Name, 
-                    "checkbox":  {
-                        "equals": False
-                    }
-                }
-            ]
-        },
-    }
-)
-resultList = my_page['results']
 
-if len(resultList) > 0:
-    for i, el in enumerate(resultList):
-        pageId = el['id']
-        my_page = notion.pages.update( ##### This checks off that the event has been put on Google Calendar
-            **{
-                "page_id": pageId, 
-                "properties": {
-                    Calendar_Notion_Name:  { 
-                        'select': {
-                            "name": DEFAULT_CALENDAR_NAME
-                        },
-                    },
-                    LastUpdatedTime_Notion_Name: {
-                        "date":{
-                            'start': notion_time(),
-                            'end': None,
-                        }
-                    }, 
-                },
-            },
-        )  
-
-
-## Filter events that have been updated since the GCal event has been made
-
-#this query will return a dictionary that we will parse for information that we want
-#look for events that are today or in the next week
-my_page = notion.databases.query(  
-    **{
-        "database_id": database_id, 
-        "filter": {
-            "and": [
-                {
-                    "property": NeedGCalUpdate_Notion_Name, 
-                    "checkbox":  {
-                        "equals": True
-                    }
-                }, 
-                {
-                    "property": On_GCal_Notion_Name, 
-                    "checkbox":  {
-                        "equals": True
-                    }
-                }, 
-                {
-                    "or": [
-                    {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "equals": todayDate
-                        }
-                    }, 
-                    {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "next_week": {}
-                        }
-                    }
-                ]   
-                },
-                {
-                    "property": Delete_Notion_Name, 
-                    "checkbox":  {
-                        "equals": False
-                    }
-                }
-            ]
-        },
-    }
-)
-resultList = my_page['results']
+######################################################################
+#METHOD TO PRINT THE PLAN (--dry-run)
+
+def estimateApiCost(plan):
+    gcalCalls = 0
+    gcalRequests = 0
+    notionCalls = 0
+    for wave in splitIntoWaves(plan.actions):
+        gcalInWave = len([action for action in wave if action.kind in GCAL_ACTION_KINDS])
+        gcalCalls += gcalInWave
+        gcalRequests += math.ceil(gcalInWave / GCAL_BATCH_SIZE)
+        notionCalls += len(wave) - gcalInWave
+    return gcalCalls, gcalRequests, notionCalls
+
+
+def printPlan(plan):
+    print('\nThe sync plan:')
+    for action in plan.actions:
+        print('  ' + action.kind.ljust(12) + ' ' + action.description)
+
+    print('\nCounts:')
+    counts = Counter(action.kind for action in plan.actions)
+    for kind in GCAL_ACTION_KINDS + NOTION_ACTION_KINDS:
+        print('  ' + kind.ljust(12) + ' ' + str(counts[kind]))
+    tierCounts = Counter(action.tier for action in plan.actions)
+    for tierName in SYNC_TIERS:
+        print('  ' + ('tier ' + tierName).ljust(12) + ' ' + str(tierCounts[tierName]))
+
+    gcalCalls, gcalRequests, notionCalls = estimateApiCost(plan)
+    print(f'\nEstimated API cost: {gcalCalls} GCal calls sent in {gcalRequests} batch requests, and {notionCalls} Notion calls')
+    print(f"(on top of the {connectionStats['GCal']['requests']} GCal and {connectionStats['Notion']['requests']} Notion requests it took to make the plan)")
+    print(f"Left in today's budgets: {apiQuota.remaining('GCal')} GCal calls and {apiQuota.remaining('Notion')} Notion calls")
 
 
-updatingNotionPageIds = []
-updatingCalEventIds = []
+######################################################################
+#METHODS TO CARRY OUT THE PLAN
+
+def makeGCalRequest(action, eventId):
+    if action.kind == 'create_gcal':
+        return service.events().insert(calendarId=action.calendarId, body=dict(action.body, id=eventId), fields=GCAL_EVENT_FIELDS)
+    elif action.kind == 'patch_gcal':
+        return service.events().patch(calendarId=action.calendarId, eventId=eventId, body=action.body, fields=GCAL_EVENT_FIELDS)
+    elif action.kind == 'move_gcal':
+        return service.events().move(calendarId=action.calendarId, eventId=eventId, destination=action.destinationId, fields=GCAL_EVENT_FIELDS)
+    else:
+        return service.events().delete(calendarId=action.calendarId, eventId=eventId)
+
+
+def finishGCalAction(action, eventId, response, renamedEvents):
+    #keeps the event cache up to date with whatever GCal handed back
+    if action.kind == 'delete_gcal':
+        gcalEventCache.remove(action.calendarId, eventId)
+        deletionTombstones.succeeded(action.eventId)
+        return
+    if action.kind == 'move_gcal':
+        gcalEventCache.remove(action.calendarId, eventId)
+        gcalEventCache.put(action.destinationId, response)
+    else:
+        gcalEventCache.put(action.calendarId, response)
+    if response['id'] != eventId: #from here on, every action for this event uses the id GCal handed back
+        print('New event id: ' + response['id'])
+        renamedEvents[action.eventId] = response['id']
+
+
+def runGCalBatch(actions, renamedEvents, queuedIds):
+    #all of these GCal changes get sent together in a single request
+    #Each change in the batch can fail on its own, so the ones that were throttled or hit a server error are sent again in a smaller batch
+    #(every GCal change is safe to send twice: a new event always has the same id, so sending it again just gets a 409)
+    failedIds = set()
+    conflicts = []
+    retryLater = []
+    journalEntries = {}
+    actionsById = {str(action.id): action for action in actions}
+
+    def fail(action, exception):
+        if isUnreachable(exception): #it gets sent from the outbox once GCal is back
+            print('GCal could not be reached, so this waits in the outbox: ' + action.description)
+            queuedIds.add(action.id)
+            return
+        print('Could not ' + action.description + ': ' + str(exception))
+        failedIds.add(action.id)
+        if action.kind == 'delete_gcal':
+            deletionTombstones.failed(action.eventId, action.pageId, str(exception))
+
+    def callback(requestId, response, exception):
+        action = actionsById[requestId]
+        if exception != None:
+            errorKind, retryAfter = classifyError(exception)
+            circuitBreakers['GCal'].record(errorKind)
+            if action.kind == 'create_gcal' and errorKind == 'conflict':
+                conflicts.append(action) #sorted out below
+                return
+            if action.kind == 'delete_gcal' and errorKind == 'not_found':
+                print('Already gone from GCal: ' + action.eventId) #which is what we wanted, so it counts as deleted
+            elif errorKind in RETRYABLE_ERRORS:
+                retryLater.append((action, exception, retryAfter))
+                return
+            else:
+                fail(action, exception)
+                return
+        else:
+            circuitBreakers['GCal'].record(None)
+        finishGCalAction(action, renamedEvents.get(action.eventId, action.eventId), response, renamedEvents)
+        journalCommit(journalEntries[action.id])
+
+    for action in actions:
+        print(action.description)
+        journalEntries[action.id] = journalBegin(action)
+
+    pending = list(actions)
+    for attempt in range(RETRY_ATTEMPTS):
+        retryLater.clear()
+        batch = service.new_batch_http_request(callback=callback)
+        for action in pending:
+            batch.add(makeGCalRequest(action, renamedEvents.get(action.eventId, action.eventId)), request_id=str(action.id))
+        try:
+            callApi('GCal', batch.execute)
+        except Exception as e: #the whole request failed, even after trying it again
+            for action in pending:
+                fail(action, e)
+            break
+        if len(retryLater) == 0:
+            break
+        if attempt == RETRY_ATTEMPTS - 1:
+            for action, exception, retryAfter in retryLater:
+                fail(action, exception)
+            break
+        print(f'Sending {len(retryLater)} GCal changes again')
+        circuitBreakers['GCal'].countRetry()
+        time.sleep(retryDelay(attempt, max((retryAfter for action, exception, retryAfter in retryLater if retryAfter != None), default=None)))
+        pending = [action for action, exception, retryAfter in retryLater]
+
+    for action in conflicts:
+        #409 means an event with this id was already made (by a run that got cut off), so we use that one
+        #unless it was deleted since then, in which case GCal won't let us reuse the id and we let it pick a new one
+        try:
+            x = callApi('GCal', service.events().get(calendarId=action.calendarId, eventId=action.eventId, fields=GCAL_EVENT_FIELDS).execute)
+            if x['status'] == 'cancelled':
+                x = callApi('GCal', service.events().insert(calendarId=action.calendarId, body=action.body, fields=GCAL_EVENT_FIELDS).execute)
+        except Exception as e:
+            fail(action, e)
+            continue
+        finishGCalAction(action, action.eventId, x, renamedEvents)
+        journalCommit(journalEntries[action.id])
 
-for result in resultList:
-    print(result)
-    print('\n')
-    pageId = result['id']
-    updatingNotionPageIds.append(pageId)
-    print('\n')
-    print(result)
-    print('\n')
+    return failedIds
+
+
+def runNotionAction(action, renamedEvents, queuedIds):
+    journalEntry = journalBegin(action)
+    properties = dict(action.properties)
+    if action.linkEventId != None:
+        properties[GCalEventId_Notion_Name] = {
+            "rich_text": [{
+                'text': {
+                    'content': renamedEvents.get(action.linkEventId, action.linkEventId)
+                }
+            }]
+        }
     try:
-        calId = result['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content']
-    except:
-        calId = DEFAULT_CALENDAR_ID
-    print(calId)
-    updatingCalEventIds.append(calId)
-
-TaskNames = []
-start_Dates = []
-end_Times = []
-Initiatives = []
-ExtraInfo = []
-URL_list = []
-CalendarList = []
-CurrentCalList = []
-
-if len(resultList) > 0:
-
-    for i, el in enumerate(resultList):
-        print('\n')
-        print(el)
-        print('\n')
-
-        TaskNames.append(el['properties'][Task_Notion_Name]['title'][0]['text']['content'])
-        start_Dates.append(el['properties'][Date_Notion_Name]['date']['start'])
-        
-        if el['properties'][Date_Notion_Name]['date']['end'] != None:
-            end_Times.append(el['properties'][Date_Notion_Name]['date']['end'])
+        if action.kind == 'create_page': #sending this twice would make two pages
+            callApi('Notion', lambda: notion.pages.create(**{"parent": {"database_id": database_id}, "properties": properties}), idempotent=False)
+        elif action.archived:
+            callApi('Notion', lambda: archiveNotionPage(action.pageId, properties))
         else:
-            end_Times.append(el['properties'][Date_Notion_Name]['date']['start'])
+            callApi('Notion', lambda: notion.pages.update(**{"page_id": action.pageId, "properties": properties}))
+    except Exception as e:
+        if isUnreachable(e): #it gets sent from the outbox once Notion is back
+            print('Notion could not be reached, so this waits in the outbox: ' + action.description)
+            queuedIds.add(action.id)
+            return None
+        print('Could not ' + action.description + ': ' + str(e))
+        return action.id
+    journalCommit(journalEntry)
+    print(action.description)
+    return None
+
+
+def runNotionActions(actions, renamedEvents, queuedIds):
+    #Notion can't take several changes in one request, so instead they get sent at the same time (up to NOTION_MAX_WORKERS at once)
+    results = notionPool.map(lambda action: runNotionAction(action, renamedEvents, queuedIds), actions)
+    return {actionId for actionId in results if actionId != None}
+
+
+def actionApi(action):
+    return 'GCal' if action.kind in GCAL_ACTION_KINDS else 'Notion'
+
+
+def planChains(plan):
+    #splits the plan into chains: an action together with everything that waits on it and everything it waits on
+    #A chain only makes sense as a whole (a move without the patch and link after it leaves the page pointing at the old calendar),
+    #so deferOverBudget lets a chain through or leaves it for the next run all at once
+    parent = {action.id: action.id for action in plan.actions}
+    def root(actionId):
+        while parent[actionId] != actionId:
+            parent[actionId] = parent[parent[actionId]]
+            actionId = parent[actionId]
+        return actionId
+    for action in plan.actions:
+        for actionId in action.after:
+            if actionId in parent:
+                parent[root(actionId)] = root(action.id)
+    chains = {}
+    for action in plan.actions: #in the order of the plan
+        chains.setdefault(root(action.id), []).append(action)
+    return list(chains.values())
+
+
+def deferOverBudget(plan):
+    #First every tier gets to make up to its share of MAX_CHANGES_PER_RUN changes, so the later tiers always get a turn,
+    #then whatever the tiers didn't use goes to the changes that didn't fit, most urgent tier first
+    #Every tier after the first is also held back if its changes would dip into the QUOTA_RESERVE of today's API budgets
+    #The rest are left for the next run, a whole chain at a time (see planChains). A chain counts towards the most urgent tier in it
+    #Nothing about them has been marked as synced yet, so the next run plans them again
+    tierNames = list(SYNC_TIERS.keys())
+    chainsOf = {tierName: [] for tierName in tierNames}
+    for chain in planChains(plan):
+        chainsOf[tierNames[min(tierRank(action.tier) for action in chain)]].append(chain)
+    if MAX_CHANGES_PER_RUN == 0:
+        shares = {tierName: math.inf for tierName in tierNames}
+    else:
+        shares = {tierName: int(MAX_CHANGES_PER_RUN * tier['share']) for tierName, tier in SYNC_TIERS.items()}
+        shares[tierNames[-1]] = MAX_CHANGES_PER_RUN - sum(shares[tierName] for tierName in tierNames[:-1]) #the last tier gets what rounding left over
+
+    deferredIds = set()
+    quotaCost = Counter() #how many calls the changes let through so far are going to take on each API
+    def chainCost(chain):
+        return Counter(actionApi(action) for action in chain)
+    def letThrough(chain):
+        quotaCost.update(chainCost(chain))
+        return len(chain)
+
+    used = 0
+    notFitting = {tierName: [] for tierName in tierNames}
+    for tierName in tierNames:
+        if tierName != tierNames[0] and apiQuota.wouldRunLow(quotaCost + sum((chainCost(chain) for chain in chainsOf[tierName]), Counter())):
+            for chain in chainsOf[tierName]:
+                deferredIds.update(action.id for action in chain)
+            continue
+        budget = shares[tierName]
+        for chain in chainsOf[tierName]:
+            if len(chain) <= budget:
+                budget -= letThrough(chain)
+                used += len(chain)
+            else:
+                notFitting[tierName].append(chain)
+
+    spare = math.inf if MAX_CHANGES_PER_RUN == 0 else MAX_CHANGES_PER_RUN - used
+    for tierName in tierNames:
+        for chain in notFitting[tierName]:
+            if len(chain) <= spare and (tierName == tierNames[0] or not apiQuota.wouldRunLow(quotaCost + chainCost(chain))):
+                spare -= letThrough(chain)
+            else:
+                deferredIds.update(action.id for action in chain)
+    if len(deferredIds) > 0:
+        print(f'Leaving {len(deferredIds)} changes for the next run (see MAX_CHANGES_PER_RUN and DAILY_CALL_BUDGETS)')
+    return deferredIds
+
+
+def executePlan(plan, limitChanges=True):
+    #limitChanges is off when the outbox is being sent, since everything in it was already let through once
+    failedIds = deferOverBudget(plan) if limitChanges else set() #deferred actions are skipped just like failed ones, along with everything waiting on them
+    queuedIds = set() #actions whose API couldn't be reached (and everything waiting on them), which go into the outbox instead of failing
+    renamedEvents = {} #planned event id -> the id GCal actually gave the event, if they're different
+    for wave in splitIntoWaves(plan.actions):
+        ready = []
+        for action in wave:
+            if action.id in failedIds:
+                continue
+            if any(actionId in failedIds for actionId in action.after):
+                print('Skipping because an earlier step failed: ' + action.description)
+                failedIds.add(action.id)
+            elif any(actionId in queuedIds for actionId in action.after) or outbox.holds(action):
+                #it has to go after something that's in the outbox, so it waits there too
+                queuedIds.add(action.id)
+            else:
+                ready.append(action)
+        ready.sort(key=lambda action: tierRank(action.tier)) #the events coming up soonest go out first
+
+        gcalActions = [action for action in ready if action.kind in GCAL_ACTION_KINDS]
+        for i in range(0, len(gcalActions), GCAL_BATCH_SIZE):
+            failedIds |= runGCalBatch(gcalActions[i:i + GCAL_BATCH_SIZE], renamedEvents, queuedIds)
+
+        failedIds |= runNotionActions([action for action in ready if action.kind in NOTION_ACTION_KINDS], renamedEvents, queuedIds)
+
+    outbox.add([action for action in plan.actions if action.id in queuedIds])
+    return failedIds | queuedIds
 
-        
-        try:
-            Initiatives.append(el['properties'][Initiative_Notion_Name]['select']['name'])
-        except:
-            Initiatives.append("")
-        
-        try: 
-            ExtraInfo.append(el['properties'][ExtraInfo_Notion_Name]['rich_text'][0]['text']['content'])
-        except:
-            ExtraInfo.append("")
-        URL_list.append(makeTaskURL(el['id'], urlRoot))
 
-        print(el)
-        # CalendarList.append(calendarDictionary[el['properties'][Calendar_Notion_Name]['select']['name']])
-        try:
-            CalendarList.append(calendarDictionary[el['properties'][Calendar_Notion_Name]['select']['name']])
-        except: #keyerror occurs when there's nothing put into the calendar in the first place
-            CalendarList.append(calendarDictionary[DEFAULT_CALENDAR_NAME])
 
-        CurrentCalList.append(el['properties'][Current_Calendar_Id_Notion_Name]['rich_text'][0]['text']['content'])
 
-        pageId = el['id']
+######################################################################
+#METHODS FOR THE SYNC JOURNAL
+#Before the script changes anything on GCal or Notion, it writes down what it's about to do in the journal file, and once it's done it writes that down too
+#If a run gets cut off halfway (computer goes to sleep, internet drops, ...), the next run reads the journal and finishes or undoes
+#only the changes that were left hanging, instead of ending up with duplicate events or pages that lost their link
 
+journalLock = threading.Lock()
 
-        ##depending on the format of the dates, we'll update the gCal event as necessary
-        try:
-            calEventId = upDateCalEvent(TaskNames[i], makeEventDescription(Initiatives[i], ExtraInfo[i]), datetime.strptime(start_Dates[i], '%Y-%m-%d'), URL_list[i], updatingCalEventIds[i], datetime.strptime(end_Times[i], '%Y-%m-%d'), CurrentCalList[i], CalendarList[i])
-        except:
-            try:
-                calEventId = upDateCalEvent(TaskNames[i], makeEventDescription(Initiatives[i], ExtraInfo[i]), datetime.strptime(start_Dates[i][:-6], "%Y-%m-%dT%H:%M:%S.000"), URL_list[i], updatingCalEventIds[i],  datetime.strptime(end_Times[i][:-6], "%Y-%m-%dT%H:%M:%S.000"), CurrentCalList[i], CalendarList[i])
-            except:
-                calEventId = upDateCalEvent(TaskNames[i], makeEventDescription(Initiatives[i], ExtraInfo[i]), datetime.strptime(start_Dates[i][:-6], "%Y-%m-%dT%H:%M:%S.%f"), URL_list[i], updatingCalEventIds[i],  datetime.strptime(end_Times[i][:-6], "%Y-%m-%dT%H:%M:%S.%f"), CurrentCalList[i], CalendarList[i])
-        
-        
-
-        my_page = notion.pages.update( ##### This updates the last time that the page in Notion was updated by the code
-            **{
-                "page_id": pageId, 
-                "properties": {
-                    LastUpdatedTime_Notion_Name: {
-                        "date":{
-                            'start': notion_time(), #has to be adjusted for when daylight savings is different
-                            'end': None,
-                        }
-                    },
-                    Current_Calendar_Id_Notion_Name: {
-                        "rich_text": [{
-                            'text': {
-                                'content': CalendarList[i]
-                            }
-                        }]
+def writeJournalLine(entry, location=journalLocation):
+    with journalLock:
+        with open(location, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno()) #make sure it's actually on the disk before we go and make the change
+
+
+def journalBegin(action):
+    runLock.check() #a run that lost its lock doesn't get to change anything
+    entryId = uuid.uuid4().hex
+    writeJournalLine({'id': entryId, 'state': 'pending', 'time': notion_time(), 'action': asdict(action)})
+    return entryId
+
+
+def journalCommit(entryId):
+    writeJournalLine({'id': entryId, 'state': 'committed'})
+
+
+def readUnfinishedJournalEntries():
+    unfinished = OrderedDict()
+    try:
+        with open(journalLocation) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #the last line can be cut off if the run died while writing it
+                    continue
+                if entry['state'] == 'pending':
+                    unfinished[entry['id']] = entry
+                else:
+                    unfinished.pop(entry['id'], None)
+    except OSError: #no journal yet
+        return []
+    return list(unfinished.values())
+
+
+def clearJournal():
+    with journalLock:
+        open(journalLocation, 'w').close()
+
+
+def getEventIfItExists(calendarId, eventId):
+    try:
+        event = callApi('GCal', service.events().get(calendarId=calendarId, eventId=eventId, fields=GCAL_EVENT_FIELDS).execute)
+    except HttpError as e:
+        if classifyError(e)[0] == 'not_found':
+            return None
+        raise
+    if event['status'] == 'cancelled':
+        return None
+    return event
+
+
+def recoverJournal():
+    runLock.check()
+    unfinished = readUnfinishedJournalEntries()
+    for entry in unfinished:
+        action = entry['action']
+        print('Finishing up something left over from a run that got cut off: ' + action['description'])
+
+        if action['kind'] == 'move_gcal':
+            #if the move went through, Notion still thinks the event is on the old calendar and every update after this would fail
+            #(NeedGCalUpdate is still checked either way, so Part 2 sends the rest of the update again)
+            if getEventIfItExists(action['destinationId'], action['eventId']) != None:
+                callApi('Notion', lambda: notion.pages.update(
+                    **{
+                        "page_id": action['pageId'],
+                        "properties": {
+                            Current_Calendar_Id_Notion_Name: {"rich_text": [{'text': {'content': action['destinationId']}}]},
+                        },
                     },
-                },
-            },
-        )
+                ))
 
+        elif action['kind'] == 'delete_gcal': #deleting twice is harmless, so just do it again
+            try:
+                callApi('GCal', service.events().delete(calendarId=action['calendarId'], eventId=action['eventId']).execute)
+            except HttpError as e:
+                if classifyError(e)[0] != 'not_found':
+                    raise
+            gcalEventCache.remove(action['calendarId'], action['eventId'])
+            callApi('Notion', lambda: archiveNotionPage(action['pageId'], {On_GCal_Notion_Name: {'checkbox': False}}))
 
+        elif action['kind'] == 'update_page' and action['archived']: #the event got deleted but its page never got archived
+            callApi('Notion', lambda: archiveNotionPage(action['pageId'], action['properties']))
 
-else:
-    print("Nothing new updated to GCal")
+        #Nothing else needs finishing: a new GCal event always gets the same id, so Part 1 making it again just picks up the one that's there,
+        #and the other changes get worked out again from scratch by Parts 2, 3 and 4
+
+        journalCommit(entry['id'])
+
+    if len(unfinished) > 0:
+        clearJournal()
+
+
+######################################################################
+#METHODS FOR THE OUTBOX
+#When GCal or Notion can't be reached (even after retrying), the changes for it go into the outbox file instead of being dropped,
+#along with anything that has to wait on them. The run carries on with everything else, so the API that's working keeps getting synced
+#At the start of the next run (or the next daemon check) the whole outbox is sent as one plan, oldest changes first, before anything new is read
+#While something for an event or page is waiting in the outbox, newer changes to it join the back of the queue so they can't be overtaken
+
+def outboxTarget(action):
+    #the GCal event or Notion page that an action changes
+    if action.kind in GCAL_ACTION_KINDS or action.pageId == None:
+        return action.eventId
+    return action.pageId
+
+
+class Outbox:
+    def __init__(self, location):
+        self.location = location
+        self.lock = threading.Lock()
+        try:
+            with open(location) as f:
+                self.actions = [SyncAction(**entry) for entry in json.load(f)]
+        except (OSError, ValueError, TypeError): #first run or a broken file, either way we just start from scratch
+            self.actions = []
+        self.nextId = max((action.id for action in self.actions), default=-1) + 1
+
+    def holds(self, action):
+        with self.lock:
+            return any(outboxTarget(queued) == outboxTarget(action) for queued in self.actions)
+
+    def findSame(self, action, after):
+        #a change that's already waiting for the same thing (a daemon that keeps running while an API is down plans the same changes every check)
+        for queued in self.actions:
+            if queued.kind != action.kind:
+                continue
+            if action.kind == 'update_page':
+                if queued.pageId == action.pageId and queued.after == after: #waiting on the same things, so they can be sent as one update
+                    return queued
+            elif (queued.eventId, queued.calendarId, queued.destinationId) == (action.eventId, action.calendarId, action.destinationId):
+                return queued
+        return None
+
+    def add(self, actions):
+        #actions come in plan order, and get new ids so they don't clash with the ones already in the outbox
+        if len(actions) == 0:
+            return
+        with self.lock:
+            newIds = {}
+            for action in actions:
+                action = SyncAction(**asdict(action))
+                after = [newIds[actionId] for actionId in action.after if actionId in newIds] #the rest already went through
+                same = self.findSame(action, after)
+                if same != None: #the newer values win
+                    if action.kind == 'patch_gcal':
+                        same.body = dict(same.body, **action.body)
+                    elif action.kind == 'update_page':
+                        same.properties = dict(same.properties, **action.properties)
+                        same.archived = same.archived or action.archived
+                        same.linkEventId = action.linkEventId or same.linkEventId
+                    newIds[action.id] = same.id
+                    continue
+                newIds[action.id] = self.nextId
+                action.id = self.nextId
+                action.after = after
+                self.nextId += 1
+                self.actions.append(action)
+        print(f'{len(self.actions)} changes are waiting in the outbox')
+
+    def take(self):
+        with self.lock:
+            actions = self.actions
+            self.actions = []
+            return actions
+
+    def save(self):
+        with self.lock:
+            with open(self.location, 'w') as f:
+                json.dump([asdict(action) for action in self.actions], f, indent=2)
+
+
+outbox = Outbox(outboxLocation)
+
+
+def flushOutbox():
+    plan = SyncPlan()
+    plan.actions = outbox.take()
+    if len(plan.actions) == 0:
+        return
+    print(f'Sending the {len(plan.actions)} changes waiting in the outbox')
+    optimizePlan(plan)
+    executePlan(plan, limitChanges=False) #whatever still can't be sent goes straight back into the outbox
+    clearJournal()
+    outbox.save()
+    gcalEventCache.save()
+    deletionTombstones.save()
 
 
 
-todayDate = datetime.today().strftime("%Y-%m-%d")
 
 ###########################################################################
-##### Part 3: Sync GCal event updates for events already in Notion back to Notion!
+##### Part 1: Take Notion Events not on GCal and move them over to GCal
 ###########################################################################
 
-##Query notion tasks already in Gcal, don't have to be updated, and are today or in the next week
-my_page = notion.databases.query( 
-    **{
-        "database_id": database_id,
-        "filter": {
-            "and": [
-                {
-                    "property": NeedGCalUpdate_Notion_Name, 
-                    "formula":{
+
+## Note that we are only querying for events inside the sync window (see SYNC_PAST_DAYS and SYNC_FUTURE_DAYS) so the code can be efficient.
+## If you want older Notion events to be on GCal too, run the script once with the backfill command
+
+def planNewNotionTasks(plan, window):
+    my_page = queryNotionDatabase(  #this query will return a dictionary that we will parse for information that we want
+        **{
+            "database_id": database_id,
+            "filter": {
+                "and": [
+                    {
+                        "property": On_GCal_Notion_Name,
+                        "checkbox":  {
+                            "equals": False
+                        }
+                    },
+                    notionWindowFilter(window),
+                    {
+                        "property": Delete_Notion_Name,
                         "checkbox":  {
                             "equals": False
                         }
                     }
-                }, 
-                {
-                    "property": On_GCal_Notion_Name, 
-                    "checkbox":  {
-                        "equals": True
+                ]
+            },
+        }
+    )
+    resultList = my_page['results']
+
+    if len(resultList) == 0:
+        print("Nothing new added to GCal")
+        return
+
+    calendarIndexes = None #only read from GCal if a task actually needs a free slot
+    for el in resultList:
+        pageId = el['id']
+        taskName = el['properties'][Task_Notion_Name]['title'][0]['text']['content']
+        start = parseNotionDate(el['properties'][Date_Notion_Name]['date']['start'])
+
+        if el['properties'][Date_Notion_Name]['date']['end'] != None:
+            end = parseNotionDate(el['properties'][Date_Notion_Name]['date']['end'])
+        else:
+            end = start
+
+        try:
+            initiative = el['properties'][Initiative_Notion_Name]['select']['name']
+        except:
+            initiative = ""
+
+        try:
+            extraInfo = el['properties'][ExtraInfo_Notion_Name]['rich_text'][0]['text']['content']
+        except:
+            extraInfo = ""
+
+        calendarId = calendarRegistry.selectedId(el['properties']) or calendarRegistry.defaultId #the default when there's nothing put into the calendar in the first place
+
+        eventId = makeGCalEventId(pageId)
+        if FIND_FREE_SLOTS == 1 and AllDayEventOption == 1 and start == end and start.hour == 0 and start.minute == 0: #only a date, so we pick the time
+            if calendarIndexes == None:
+                calendarIndexes = buildCalendarIndexes(window)
+            slotStart = findFreeSlot(calendarIndexes[calendarId], start, eventId, taskName)
+            if slotStart != None:
+                start = slotStart
+                end = slotStart + timedelta(minutes=DEFAULT_EVENT_LENGTH)
+            else:
+                print('No free time on ' + start.strftime("%Y-%m-%d") + ' for ' + taskName + ', so it goes at the default time')
+        tier = eventTier(start)
+        createAction = plan.add('create_gcal', 'Adding this event to calendar: ' + taskName, tier=tier, pageId=pageId, eventId=eventId, calendarId=calendarId,
+            body=makeEventBody(taskName, makeEventDescription(initiative, extraInfo), start, makeTaskURL(pageId, urlRoot), end))
+
+        properties = { ##### This checks off that the event has been put on Google Calendar and puts the GCal Id into the Notion Dashboard
+            On_GCal_Notion_Name: {
+                "checkbox": True
+            },
+            LastUpdatedTime_Notion_Name: {
+                "date":{
+                    'start': notion_time(),
+                    'end': None,
+                }
+            },
+            Current_Calendar_Id_Notion_Name: {
+                "rich_text": [{
+                    'text': {
+                        'content': calendarId
                     }
+                }]
+            },
+        }
+        if calendarId == calendarRegistry.defaultId: #this means that there is no calendar assigned on Notion
+            properties[Calendar_Notion_Name] = {
+                'select': {
+                    "name": DEFAULT_CALENDAR_NAME
                 },
-                {
-                    "or": [
+            }
+        plan.add('update_page', 'Linking this Notion task to its GCal event: ' + taskName, after=[createAction], tier=tier, pageId=pageId, properties=properties, linkEventId=eventId)
+
+
+
+###########################################################################
+##### Part 2: Updating GCal Events that Need To Be Updated (Changed on Notion but need to be changed on GCal)
+###########################################################################
+
+def planNotionChanges(plan, window):
+    #Just gotta put a fail-safe in here in case people deleted the Calendar Variable
+    #this queries items in the next week where the Calendar select thing is empty
+    my_page = queryNotionDatabase(
+        **{
+            "database_id": database_id,
+            "filter": {
+                "and": [
                     {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "equals": todayDate
+                        "property": Calendar_Notion_Name,
+                        "select":  {
+                            "is_empty": True
                         }
-                    }, 
+                    },
+                    notionWindowFilter(window),
                     {
-                        "property": Date_Notion_Name, 
-                        "date": {
-                            "next_week": {}
+                        "property": Delete_Notion_Name,
+                        "checkbox":  {
+                            "equals": False
                         }
                     }
-                ]   
+                ]
+            },
+        },
+        properties=[Calendar_Notion_Name], #nothing but the page id is read here
+    )
+
+    for el in my_page['results']:
+        plan.add('update_page', 'Putting a Notion task with no calendar on ' + DEFAULT_CALENDAR_NAME, tier=eventTier(None), pageId=el['id'], properties={
+            Calendar_Notion_Name:  {
+                'select': {
+                    "name": DEFAULT_CALENDAR_NAME
                 },
-                {
-                    "property": Delete_Notion_Name, 
-                    "checkbox":  {
-                        "equals": False
-                    }
+            },
+            LastUpdatedTime_Notion_Name: {
+                "date":{
+                    'start': notion_time(),
+                    'end': None,
                 }
-            ]
-        },
-    }
-)
-
-resultList = my_page['results']
-
-
-#Comparison section: 
-# We need to see what times between GCal and Notion are not the same, so we are going to convert all of the notion date/times into 
-## datetime values and then compare that against the datetime value of the GCal event. If they are not the same, then we change the Notion 
-### event as appropriate
-notion_IDs_List = []
-notion_start_datetimes = []
-notion_end_datetimes = []
-notion_gCal_IDs = [] #we will be comparing this against the gCal_datetimes
-gCal_start_datetimes = []
-gCal_end_datetimes = []
-
-notion_gCal_CalIds = [] #going to fill this in from the select option, not the text option. 
-notion_gCal_CalNames = []
-gCal_CalIds = []
-
-for result in resultList:
-    notion_IDs_List.append(result['id']) 
-    notion_start_datetimes.append(result['properties'][Date_Notion_Name]['date']['start'])
-    notion_end_datetimes.append(result['properties'][Date_Notion_Name]['date']['end'])
-    notion_gCal_IDs.append(result['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content'])
-    try:
-        notion_gCal_CalIds.append(calendarDictionary[result['properties'][Calendar_Notion_Name]['select']['name']])
-        notion_gCal_CalNames.append(result['properties'][Calendar_Notion_Name]['select']['name'])
-    except: #keyerror occurs when there's nothing put into the calendar in the first place
-        notion_gCal_CalIds.append(calendarDictionary[DEFAULT_CALENDAR_NAME])
-        notion_gCal_CalNames.append(result['properties'][Calendar_Notion_Name]['select']['name'])
+            },
+        })
 
 
+    ## Filter events that have been updated since the GCal event has been made
+
+    #this query will return a dictionary that we will parse for information that we want
+    #look for events that are today or in the next week
+    my_page = queryNotionDatabase(
+        **{
+            "database_id": database_id,
+            "filter": {
+                "and": [
+                    {
+                        "property": NeedGCalUpdate_Notion_Name,
+                        "checkbox":  {
+                            "equals": True
+                        }
+                    },
+                    {
+                        "property": On_GCal_Notion_Name,
+                        "checkbox":  {
+                            "equals": True
+                        }
+                    },
+                    notionWindowFilter(window),
+                    {
+                        "property": Delete_Notion_Name,
+                        "checkbox":  {
+                            "equals": False
+                        }
+                    }
+                ]
+            },
+        }
+    )
+    resultList = my_page['results']
+
+    if len(resultList) == 0:
+        print("Nothing new updated to GCal")
+        return
+
+    for el in resultList:
+        pageId = el['id']
+        taskName = el['properties'][Task_Notion_Name]['title'][0]['text']['content']
 
-#the reason we take off the last 6 characters is so we can focus in on just the date and time instead of any extra info
-for  i in range(len(notion_start_datetimes)):    
-    try:
-        notion_start_datetimes[i] = datetime.strptime(notion_start_datetimes[i], "%Y-%m-%d")
-    except:
         try:
-            notion_start_datetimes[i] = datetime.strptime(notion_start_datetimes[i][:-6], "%Y-%m-%dT%H:%M:%S.000")
-        except:
-            notion_start_datetimes[i] = datetime.strptime(notion_start_datetimes[i][:-6], "%Y-%m-%dT%H:%M:%S.%f")
+            eventId = el['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content']
+        except: #the page never got linked to a GCal event, so there's nothing to update
+            print('No GCal event to update for: ' + taskName)
+            continue
+
+        start = parseNotionDate(el['properties'][Date_Notion_Name]['date']['start'])
+        if el['properties'][Date_Notion_Name]['date']['end'] != None:
+            end = parseNotionDate(el['properties'][Date_Notion_Name]['date']['end'])
+        else:
+            end = start
 
-for  i in range(len(notion_end_datetimes)):    
-    if notion_end_datetimes[i] != None:
         try:
-            notion_end_datetimes[i] = datetime.strptime(notion_end_datetimes[i], "%Y-%m-%d")
+            initiative = el['properties'][Initiative_Notion_Name]['select']['name']
         except:
-            try:
-                notion_end_datetimes[i] = datetime.strptime(notion_end_datetimes[i][:-6], "%Y-%m-%dT%H:%M:%S.000")
-            except:
-                notion_end_datetimes[i] = datetime.strptime(notion_end_datetimes[i][:-6], "%Y-%m-%dT%H:%M:%S.%f")
-    else:
-        notion_end_datetimes[i] = notion_start_datetimes[i] #the reason we're doing this weird ass thing is because when we put the end time into the update or make GCal event, it'll be representative of the date
+            initiative = ""
 
+        try:
+            extraInfo = el['properties'][ExtraInfo_Notion_Name]['rich_text'][0]['text']['content']
+        except:
+            extraInfo = ""
 
-##We use the gCalId from the Notion dashboard to get retrieve the start Time from the gCal event
-value =''
-exitVar = ''
-for gCalId in notion_gCal_IDs:  
+        calendarId = calendarRegistry.selectedId(el['properties']) or calendarRegistry.defaultId #the default when there's nothing put into the calendar in the first place
 
-    for calendarID in calendarDictionary.keys(): #just check all of the calendars of interest for info about the event
-        print('Trying ' + calendarID + ' for ' + gCalId)
         try:
-            x = service.events().get(calendarId=calendarDictionary[calendarID], eventId = gCalId).execute()
+            currentCalendarId = el['properties'][Current_Calendar_Id_Notion_Name]['rich_text'][0]['text']['content']
         except:
-            print('Event not found')
-            x = {'status': 'unconfirmed'}
-        if x['status'] == 'confirmed':
-            gCal_CalIds.append(calendarID)
-            value = x
+            currentCalendarId = calendarId
+
+        event = makeEventBody(taskName, makeEventDescription(initiative, extraInfo), start, makeTaskURL(pageId, urlRoot), end)
+        tier = eventTier(start)
+        waitFor = []
+
+        if currentCalendarId != calendarId: #When we have to move the event to a new calendar. We must move the event over to the new calendar and then update the information on the event
+            waitFor = [plan.add('move_gcal', 'Moving this event to a new calendar: ' + taskName, tier=tier, pageId=pageId, eventId=eventId, calendarId=currentCalendarId, destinationId=calendarId)]
+
+        changes = findEventChanges(event, gcalEventCache.get(currentCalendarId, eventId))
+        if len(changes) > 0: #only send the fields that are different from what GCal already has
+            waitFor = [plan.add('patch_gcal', 'Updating this event on calendar: ' + taskName + ' (' + ', '.join(changes.keys()) + ')', after=waitFor, tier=tier, pageId=pageId, eventId=eventId, calendarId=calendarId, body=changes)]
         else:
-            continue
-            
-    print(value)
-    print('\n') 
-    try:
-        gCal_start_datetimes.append(datetime.strptime(value['start']['dateTime'][:-6], "%Y-%m-%dT%H:%M:%S"))
-    except:
-        date = datetime.strptime(value['start']['date'], "%Y-%m-%d")
-        x = datetime(date.year, date.month, date.day, 0, 0, 0)
-        # gCal_start_datetimes.append(datetime.strptime(x, "%Y-%m-%dT%H:%M:%S"))
-        gCal_start_datetimes.append(x)
-    try:
-        gCal_end_datetimes.append(datetime.strptime(value['end']['dateTime'][:-6], "%Y-%m-%dT%H:%M:%S"))
-    except:
-        date = datetime.strptime(value['end']['date'], "%Y-%m-%d")
-        x = datetime(date.year, date.month, date.day, 0, 0, 0) - timedelta(days=1)
-        # gCal_end_datetimes.append(datetime.strptime(value['end']['date'][:-6], "%Y-%m-%dT%H:%M:%S"))
-        gCal_end_datetimes.append(x)
+            print('Nothing changed on GCal for: ', taskName)
 
-#Now we iterate and compare the time on the Notion Dashboard and the start time of the GCal event
-#If the datetimes don't match up,  then the Notion  Dashboard must be updated
+        plan.add('update_page', 'Marking this Notion task as synced: ' + taskName, after=waitFor, tier=tier, pageId=pageId, properties={ ##### This updates the last time that the page in Notion was updated by the code
+            LastUpdatedTime_Notion_Name: {
+                "date":{
+                    'start': notion_time(),
+                    'end': None,
+                }
+            },
+            Current_Calendar_Id_Notion_Name: {
+                "rich_text": [{
+                    'text': {
+                        'content': calendarId
+                    }
+                }]
+            },
+        })
 
-new_notion_start_datetimes = ['']*len(notion_start_datetimes)
-new_notion_end_datetimes = ['']*len(notion_end_datetimes)
 
 
-for i in range(len(new_notion_start_datetimes)):
-    if notion_start_datetimes[i] != gCal_start_datetimes[i]:
-        new_notion_start_datetimes[i] = gCal_start_datetimes[i]
-    
-    if notion_end_datetimes[i] != gCal_end_datetimes[i]: #this means that there is no end time in notion 
-        new_notion_end_datetimes[i] = gCal_end_datetimes[i]
-
-print('test')
-print(new_notion_start_datetimes)
-print(new_notion_end_datetimes)
-print('\n')
-for i in range(len(notion_gCal_IDs)):
-    print(notion_start_datetimes[i], gCal_start_datetimes[i], notion_gCal_IDs[i])
-
-
-for i in range(len(new_notion_start_datetimes)):
-    if new_notion_start_datetimes[i]  != '' and new_notion_end_datetimes[i] != '': #both start and end time need to be updated
-        start = new_notion_start_datetimes[i]
-        end = new_notion_end_datetimes[i]
- 
-        if start.hour == 0 and start.minute == 0 and start == end: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': start.strftime("%Y-%m-%d"),
-                                'end': None,
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-        elif start.hour == 0 and start.minute == 0 and end.hour == 0 and end.minute == 0: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': start.strftime("%Y-%m-%d"),
-                                'end': end.strftime("%Y-%m-%d"),
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-        else: #update Notin using datetime format 
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': DateTimeIntoNotionFormat(start),
-                                'end': DateTimeIntoNotionFormat(end),
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-    elif new_notion_start_datetimes[i]  != '': #only start time need to be updated
-        start = new_notion_start_datetimes[i]
-        end = notion_end_datetimes[i]
- 
-        if start.hour == 0 and start.minute == 0 and start == end: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': start.strftime("%Y-%m-%d"),
-                                'end': None,
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-        elif start.hour == 0 and start.minute == 0 and end.hour == 0 and end.minute == 0: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': start.strftime("%Y-%m-%d"),
-                                'end': end.strftime("%Y-%m-%d"),
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-        else: #update Notin using datetime format 
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': DateTimeIntoNotionFormat(start),
-                                'end': DateTimeIntoNotionFormat(end),
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-    elif new_notion_end_datetimes[i] != '': #only end time needs to be updated
-        start = notion_start_datetimes[i]
-        end = new_notion_end_datetimes[i]
-
-        if start.hour == 0 and start.minute == 0 and start == end: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': start.strftime("%Y-%m-%d"),
-                                'end': None,
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-        elif start.hour == 0 and start.minute == 0 and end.hour == 0 and end.minute == 0: #you're given 12 am dateTimes so you want to enter them as dates (not datetimes) into Notion
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': start.strftime("%Y-%m-%d"),
-                                'end': end.strftime("%Y-%m-%d"),
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-        else: #update Notin using datetime format 
-            my_page = notion.pages.update( #update the notion dashboard with the new datetime and update the last updated time
-                **{
-                    "page_id": notion_IDs_List[i], 
-                    "properties": {
-                        Date_Notion_Name: {
-                            "date":{
-                                'start': DateTimeIntoNotionFormat(start),
-                                'end': DateTimeIntoNotionFormat(end),
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "date":{
-                                'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                                'end': None,
-                            }
-                        }
-                    },
-                },
-            )
-    else: #nothing needs to be updated here
-        continue 
+###########################################################################
+##### Part 3: Sync GCal event updates for events already in Notion back to Notion!
+###########################################################################
 
-print(notion_IDs_List)
-print('\n')
-print(gCal_CalIds)
+##We use the gCalId from the Notion dashboard to get retrieve the start Time from the gCal event
+def getEventFromCalendar(threadService, lookup):
+    gCalId, calendarID = lookup
+    print('Trying ' + calendarID + ' for ' + gCalId)
+    try:
+        return getGCalEvent(threadService, calendarRegistry.idOf[calendarID], gCalId)
+    except Exception as e:
+        if classifyError(e)[0] == 'not_found':
+            print('Event not found')
+            return {'status': 'unconfirmed'}
+        #GCal couldn't be asked (even after retrying), which doesn't mean the event isn't there
+        print('Could not check ' + calendarID + ' for ' + gCalId + ': ' + str(e))
+        return {'status': 'unreachable'}
 
-CalNames = list(calendarDictionary.keys())
-CalIds = list(calendarDictionary.values())
 
-for i, gCalId in enumerate(gCal_CalIds): #instead of checking, just update the notion datebase with whatever calendar the event is on
-    print('GcalId: ' + gCalId)
-    my_page = notion.pages.update( ##### This puts the the GCal Id into the Notion Dashboard
+def planGCalChanges(plan, window):
+    ##Query notion tasks already in Gcal, don't have to be updated, and are today or in the next week
+    my_page = queryNotionDatabase(
         **{
-            "page_id": notion_IDs_List[i], 
-            "properties": {
-                Current_Calendar_Id_Notion_Name: { #this is the text
-                    "rich_text": [{
-                        'text': {
-                            'content': CalIds[CalNames.index(gCalId)]
+            "database_id": database_id,
+            "filter": {
+                "and": [
+                    {
+                        "property": NeedGCalUpdate_Notion_Name,
+                        "formula":{
+                            "checkbox":  {
+                                "equals": False
+                            }
                         }
-                    }]
-                },
-                Calendar_Notion_Name:  { #this is the select
-                    'select': {
-                        "name": gCalId 
                     },
-                },
-                LastUpdatedTime_Notion_Name: {
-                    "date":{
-                        'start': notion_time(), #has to be adjsuted for when daylight savings is different
-                        'end': None,
+                    {
+                        "property": On_GCal_Notion_Name,
+                        "checkbox":  {
+                            "equals": True
+                        }
+                    },
+                    notionWindowFilter(window),
+                    {
+                        "property": Delete_Notion_Name,
+                        "checkbox":  {
+                            "equals": False
+                        }
                     }
-                }
+                ]
             },
         },
+        properties=[Date_Notion_Name, GCalEventId_Notion_Name, Calendar_Notion_Name, Current_Calendar_Id_Notion_Name],
     )
-    
+    resultList = my_page['results']
+
+    calendarNames = calendarRegistry.syncedNames()
+    calendarNameOfId = calendarRegistry.nameOf
+    notion_gCal_IDs = [result['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content'] for result in resultList]
+    foundEvents = {}
+
+    #First we only check the calendar each event was on the last time we saw it. Events don't move around much, so that's usually the only call needed
+    #If GCal couldn't be reached for an event, it's left alone until the next run instead of being looked for on every other calendar
+    firstLookups = [(gCalId, calendarNameOfId[gcalEventCache.calendarOf(gCalId)]) for gCalId in notion_gCal_IDs if calendarNameOfId.get(gcalEventCache.calendarOf(gCalId)) in calendarNames]
+    unreachable = set()
+    for (gCalId, calendarID), x in zip(firstLookups, fanOutCalendarReads(getEventFromCalendar, firstLookups)):
+        if x['status'] == 'confirmed':
+            foundEvents[gCalId] = (calendarID, x)
+        elif x['status'] == 'unreachable':
+            unreachable.add(gCalId)
 
+    #every (event, calendar) pair that is left is checked at the same time on the worker pool instead of one calendar after the other
+    lookups = [(gCalId, calendarID) for gCalId in notion_gCal_IDs if gCalId not in foundEvents and gCalId not in unreachable for calendarID in calendarNames]
+    for (gCalId, calendarID), x in zip(lookups, fanOutCalendarReads(getEventFromCalendar, lookups)):
+        if x['status'] == 'confirmed':
+            foundEvents[gCalId] = (calendarID, x)
 
-###########################################################################
-##### Part 4: Bring events (not in Notion already) from GCal to Notion
-###########################################################################
 
-##First, we get a list of all of the GCal Event Ids from the Notion Dashboard.
+    #Comparison section:
+    # We need to see what times between GCal and Notion are not the same, so we are going to convert all of the notion date/times into
+    ## datetime values and then compare that against the datetime value of the GCal event. If they are not the same, then we change the Notion
+    ### event as appropriate
+    #Only the things that are actually different between GCal and Notion get written back, and each page gets at most one write
+    #If nothing changed, nothing is written. That keeps Last Edited Time (and so the NeedGCalUpdate formula) from being bumped for no reason
+    for result, gCalId in zip(resultList, notion_gCal_IDs):
+        if gCalId not in foundEvents: #the event isn't on any of the calendars, so there's nothing to compare the Notion page against
+            continue
+        gCalCalendarName, value = foundEvents[gCalId]
 
-my_page = notion.databases.query( 
-    **{
-        "database_id": database_id,
-        "filter": {
-                "and": [
-                {
-                    "property": GCalEventId_Notion_Name, 
-                    "text":  {
-                        "is_not_empty": True
-                    }
+        notionStart = parseNotionDate(result['properties'][Date_Notion_Name]['date']['start'])
+        if result['properties'][Date_Notion_Name]['date']['end'] != None:
+            notionEnd = parseNotionDate(result['properties'][Date_Notion_Name]['date']['end'])
+        else:
+            notionEnd = notionStart #the reason we're doing this weird ass thing is because when we put the end time into the update or make GCal event, it'll be representative of the date
+
+        try:
+            notionCalendarName = result['properties'][Calendar_Notion_Name]['select']['name']
+        except: #there's nothing put into the calendar in the first place
+            notionCalendarName = ''
+        try:
+            notionCurrentCalendarId = result['properties'][Current_Calendar_Id_Notion_Name]['rich_text'][0]['text']['content']
+        except:
+            notionCurrentCalendarId = ''
+
+        gCalStart = parseGCalTime(value['start'], isEnd=False)
+        gCalEnd = parseGCalTime(value['end'], isEnd=True)
+        print(notionStart, gCalStart, gCalId)
+
+        properties = {}
+
+        if notionStart != gCalStart or notionEnd != gCalEnd: #the start time, end time or both need to be updated
+            properties[Date_Notion_Name] = makeNotionDate(gCalStart, gCalEnd)
+
+        if gCalCalendarName != notionCalendarName: #the event is on a different calendar than the select says
+            properties[Calendar_Notion_Name] = { #this is the select
+                'select': {
+                    "name": gCalCalendarName
                 },
-                {
-                    "property": Delete_Notion_Name, 
-                    "checkbox":  {
-                        "equals": False
+            }
+
+        if calendarRegistry.idOf[gCalCalendarName] != notionCurrentCalendarId: #the text with the calendar id is out of date
+            properties[Current_Calendar_Id_Notion_Name] = { #this is the text
+                "rich_text": [{
+                    'text': {
+                        'content': calendarRegistry.idOf[gCalCalendarName]
                     }
-                }
-            ]
-        },
-    }
-)
-
-my_page = notion.databases.query( 
-    **{
-        "database_id": database_id,
-        "filter": {
-            "property": GCalEventId_Notion_Name, 
-            "text":  {
-                "is_not_empty": True
+                }]
             }
-        },
-    }
-)
 
-resultList = my_page['results']
+        if len(properties) == 0: #nothing needs to be updated here
+            continue
 
-ALL_notion_gCal_Ids =[]
+        properties[LastUpdatedTime_Notion_Name] = {
+            "date":{
+                'start': notion_time(),
+                'end': None,
+            }
+        }
+        plan.add('update_page', 'Updating this Notion task from GCal (' + ', '.join(properties.keys()) + '): ' + value.get('summary', ''), tier=eventTier(gCalStart), pageId=result['id'], properties=properties)
 
-for result in resultList:
-    ALL_notion_gCal_Ids.append(result['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content'])
 
 
-##Get the GCal Ids and other Event Info from Google Calendar 
+###########################################################################
+##### Part 4: Bring events (not in Notion already) from GCal to Notion
+###########################################################################
 
-events = []
-for el in calendarDictionary.keys(): #get all the events from all calendars of interest
-    x = service.events().list(calendarId = calendarDictionary[el], maxResults = 2000, timeMin = googleQuery() ).execute()    
-    events.extend(x['items'])
-    
-print(events)
+def listCalendarEvents(threadService, lookup):
+    calendarName, window = lookup
+    windowStart, windowEnd = window
+    items = []
+    pageToken = None
+    while True: #GCal hands the events back a page at a time
+        #showDeleted is there so the single times of a recurring event that got cancelled come back too
+        x = callApi('GCal', threadService.events().list(calendarId = calendarRegistry.idOf[calendarName], maxResults = 2000, timeMin = googleQueryTime(windowStart), timeMax = googleQueryTime(windowEnd), showDeleted = True, pageToken = pageToken, fields=GCAL_LIST_FIELDS).execute)
+        for event in x['items']:
+            gcalEventCache.put(calendarRegistry.idOf[calendarName], event)
+        items.extend(x['items'])
+        pageToken = x.get('nextPageToken')
+        if pageToken == None:
+            return expandRecurringEvents(threadService, calendarRegistry.idOf[calendarName], items, window)
 
-# calItems = events['items']
-calItems = events
 
-calName = [item['summary'] for item in calItems]
+##First, we get a list of all of the GCal Event Ids from the Notion Dashboard.
+#This isn't limited to the sync window (an event can be moved into the window on GCal), so it's only read once per run
+def getNotionEventIds():
+    my_page = queryNotionDatabase(
+        **{
+            "database_id": database_id,
+            "filter": {
+                "property": GCalEventId_Notion_Name,
+                "text":  {
+                    "is_not_empty": True
+                }
+            },
+        },
+        properties=[GCalEventId_Notion_Name], #only the ids are needed here
+    )
+    return {result['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content'] for result in my_page['results']}
 
-gCal_calendarId = [item['organizer']['email'] for item in calItems] #this is to get all of the calendarIds for each event
 
-CalNames = list(calendarDictionary.keys())
-CalIds = list(calendarDictionary.values())
-gCal_calendarName = [ CalNames[CalIds.index(x)] for x in gCal_calendarId]
+def madeFromNotion(event):
+    #Part 1 puts the link to the Notion task in the event's source, so an event with one already has a page
+    #(if the link back to the event never made it onto the page, a push picks that up again, so it mustn't be brought over as a second page)
+    return event.get('source', {}).get('url', '').startswith(urlRoot)
 
-calStartDates = []
-calEndDates = []
-for el in calItems:
-    try:
-        calStartDates.append(datetime.strptime(el['start']['dateTime'][:-6], "%Y-%m-%dT%H:%M:%S"))
-    except:
-        date = datetime.strptime(el['start']['date'], "%Y-%m-%d")
-        x = datetime(date.year, date.month, date.day, 0, 0, 0)
-        # gCal_start_datetimes.append(datetime.strptime(x, "%Y-%m-%dT%H:%M:%S"))
-        calStartDates.append(x)
-    try:
-        calEndDates.append(datetime.strptime(el['end']['dateTime'][:-6], "%Y-%m-%dT%H:%M:%S"))
-    except:
-        date = datetime.strptime(el['end']['date'], "%Y-%m-%d")
-        x = datetime(date.year, date.month, date.day, 0, 0, 0) 
-        # gCal_end_datetimes.append(datetime.strptime(value['end']['date'][:-6], "%Y-%m-%dT%H:%M:%S"))
-        calEndDates.append(x)
 
+def planNewGCalEvents(plan, window, notionEventIds):
+    #the events Part 1 is about to make count too, otherwise they'd come right back as new pages
+    ALL_notion_gCal_Ids = notionEventIds | plan.plannedEventIds
 
-calIds = [item['id'] for item in calItems]
-# calDescriptions = [item['description'] for item in calItems]
-calDescriptions = []
-for item in calItems:
-    try: 
-        calDescriptions.append(item['description'])
-    except:
-        calDescriptions.append(' ')
 
+    ##Get the GCal Ids and other Event Info from Google Calendar
+    #every item is kept with the calendar it was listed from. The organizer isn't always the calendar (e.g. an event someone invited you to)
+    calItems = []
+    calendarNames = calendarRegistry.syncedNames()
+    for calendarName, calendarEvents in zip(calendarNames, fanOutCalendarReads(listCalendarEvents, [(calendarName, window) for calendarName in calendarNames])): #get all the events from all calendars of interest at the same time
+        calItems.extend((calendarRegistry.idOf[calendarName], item) for item in calendarEvents)
 
-#Now, we compare the Ids from Notion and Ids from GCal. If the Id from GCal is not in the list from Notion, then 
-## we know that the event does not exist in Notion yet, so we should bring that over. 
+    #Now, we compare the Ids from Notion and Ids from GCal. If the Id from GCal is not in the list from Notion, then
+    ## we know that the event does not exist in Notion yet, so we should bring that over.
+    for calendarId, item in calItems:
+        if item['id'] in ALL_notion_gCal_Ids or madeFromNotion(item):
+            continue
+        notionEventIds.add(item['id']) #an event can show up more than once (on every day it spans in a backfill), but it only gets one page
+        ALL_notion_gCal_Ids.add(item['id'])
 
-for i in range(len(calIds)):
-    if calIds[i] not in ALL_notion_gCal_Ids:
-    
-        if calStartDates[i] == calEndDates[i] - timedelta(days=1): #only add in the start DATE
-            #Here, we create a new page for every new GCal event
-            end = calEndDates[i] - timedelta(days=1)
-            my_page = notion.pages.create(
-                **{
-                    "parent": {
-                        "database_id": database_id,
-                    },
-                    "properties": {
-                        Task_Notion_Name: {
-                            "type": 'title',
-                            "title": [
-                            {
-                                "type": 'text',
-                                "text": {
-                                "content": calName[i],
-                                },
-                            },
-                            ],
-                        },
-                        Date_Notion_Name: {
-                            "type": 'date',
-                            'date': {
-                                'start': calStartDates[i].strftime("%Y-%m-%d"),
-                                'end': None, 
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "type": 'date',
-                            'date': {
-                                'start': notion_time(),
-                                'end': None,
-                            }
-                        },
-                        ExtraInfo_Notion_Name:  {
-                            "type": 'rich_text', 
-                            "rich_text": [{
-                                'text': {
-                                    'content': calDescriptions[i]
-                                }
-                            }]
-                        },
-                        GCalEventId_Notion_Name: {
-                            "type": "rich_text", 
-                            "rich_text": [{
-                                'text': {
-                                    'content': calIds[i]
-                                }
-                            }]
-                        }, 
-                        On_GCal_Notion_Name: {
-                            "type": "checkbox", 
-                            "checkbox": True
-                        },
-                        Current_Calendar_Id_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': gCal_calendarId[i]
-                                }
-                            }]
-                        },
-                        Calendar_Notion_Name:  { 
-                            'select': {
-                                "name": gCal_calendarName[i]
-                            },
-                        }
-                    },
-                },
-            )
+        #Here, we create a new page for every new GCal event
+        plan.add('create_page', 'Adding this event to Notion: ' + item['summary'], tier=eventTier(parseGCalTime(item['start'], isEnd=False)), eventId=item['id'], calendarId=calendarId,
+            properties=makeNotionPageForEvent(item, calendarId))
 
-        elif calStartDates[i].hour == 0 and calStartDates[i].minute == 0 and calEndDates[i].hour == 0 and calEndDates[i].minute == 0: #add start and end in DATE format
-            #Here, we create a new page for every new GCal event
-            end = calEndDates[i] - timedelta(days=1)
 
-            my_page = notion.pages.create(
-                **{
-                    "parent": {
-                        "database_id": database_id,
-                    },
-                    "properties": {
-                        Task_Notion_Name: {
-                            "type": 'title',
-                            "title": [
-                            {
-                                "type": 'text',
-                                "text": {
-                                "content": calName[i],
-                                },
-                            },
-                            ],
-                        },
-                        Date_Notion_Name: {
-                            "type": 'date',
-                            'date': {
-                                'start': calStartDates[i].strftime("%Y-%m-%d"),
-                                'end': end.strftime("%Y-%m-%d"), 
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "type": 'date',
-                            'date': {
-                                'start': notion_time(),
-                                'end': None,
-                            }
-                        },
-                        ExtraInfo_Notion_Name:  {
-                            "type": 'rich_text', 
-                            "rich_text": [{
-                                'text': {
-                                    'content': calDescriptions[i]
-                                }
-                            }]
-                        },
-                        GCalEventId_Notion_Name: {
-                            "type": "rich_text", 
-                            "rich_text": [{
-                                'text': {
-                                    'content': calIds[i]
-                                }
-                            }]
-                        }, 
-                        On_GCal_Notion_Name: {
-                            "type": "checkbox", 
-                            "checkbox": True
-                        },
-                        Current_Calendar_Id_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': gCal_calendarId[i]
-                                }
-                            }]
-                        },
-                        Calendar_Notion_Name:  { 
-                            'select': {
-                                "name": gCal_calendarName[i]
-                            },
+
+###########################################################################
+##### Part 5: Deletion Sync -- If marked Done in Notion, then it will delete the GCal event (and the Notion event once Python API updates)
+###########################################################################
+
+def planDeletions(plan):
+    if DELETE_OPTION != 0:
+        return
+
+    my_page = queryNotionDatabase(
+        **{
+            "database_id": database_id,
+            "filter": {
+                "and":[
+                    {
+                        "property": GCalEventId_Notion_Name,
+                        "text":  {
+                            "is_not_empty": True
                         }
                     },
-                },
-            )
-
-        else: #regular datetime stuff
-            #Here, we create a new page for every new GCal event
-            my_page = notion.pages.create(
-                **{
-                    "parent": {
-                        "database_id": database_id,
-                    },
-                    "properties": {
-                        Task_Notion_Name: {
-                            "type": 'title',
-                            "title": [
-                            {
-                                "type": 'text',
-                                "text": {
-                                "content": calName[i],
-                                },
-                            },
-                            ],
-                        },
-                        Date_Notion_Name: {
-                            "type": 'date',
-                            'date': {
-                                'start': DateTimeIntoNotionFormat(calStartDates[i]),
-                                'end': DateTimeIntoNotionFormat(calEndDates[i]), 
-                            }
-                        },
-                        LastUpdatedTime_Notion_Name: {
-                            "type": 'date',
-                            'date': {
-                                'start': notion_time(),
-                                'end': None,
-                            }
-                        },
-                        ExtraInfo_Notion_Name:  {
-                            "type": 'rich_text', 
-                            "rich_text": [{
-                                'text': {
-                                    'content': calDescriptions[i]
-                                }
-                            }]
-                        },
-                        GCalEventId_Notion_Name: {
-                            "type": "rich_text", 
-                            "rich_text": [{
-                                'text': {
-                                    'content': calIds[i]
-                                }
-                            }]
-                        }, 
-                        On_GCal_Notion_Name: {
-                            "type": "checkbox", 
-                            "checkbox": True
-                        },
-                        Current_Calendar_Id_Notion_Name: {
-                            "rich_text": [{
-                                'text': {
-                                    'content': gCal_calendarId[i]
-                                }
-                            }]
-                        },
-                        Calendar_Notion_Name:  { 
-                            'select': {
-                                "name": gCal_calendarName[i]
-                            },
+                    {
+                        "property": On_GCal_Notion_Name,
+                        "checkbox":  {
+                            "equals": True
                         }
                     },
-                },
-            )
+                    {
+                        "property": Delete_Notion_Name,
+                        "checkbox":  {
+                            "equals": True
+                        }
+                    }
+                ] + notionCalendarFilters()
+            },
+        },
+        properties=[GCalEventId_Notion_Name, Calendar_Notion_Name, Current_Calendar_Id_Notion_Name, Date_Notion_Name],
+    )
 
-        print(f'Added this event to Notion: {calName[i]}')
+    for el in my_page['results']: #delete gCal event, then archive the Notion task
+        eventId = el['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content']
+        pageId = el['id']
+
+        if not deletionTombstones.shouldTry(eventId): #this one failed recently, so it waits its turn instead of failing again on every run
+            continue
+
+        #if the Calendar select is empty or isn't one of the calendars, we go with the calendar the event was last put on
+        calendarID = calendarRegistry.selectedId(el['properties']) or calendarRegistry.currentId(el['properties']) or calendarRegistry.defaultId
+
+        try:
+            tier = eventTier(parseNotionDate(el['properties'][Date_Notion_Name]['date']['start']))
+        except: #no date on the task
+            tier = eventTier(None)
+
+        deleteAction = plan.add('delete_gcal', 'Deleting this event from GCal: ' + eventId, tier=tier, pageId=pageId, eventId=eventId, calendarId=calendarID)
+        #On GCal? gets unchecked too, so the task stops showing up here even if archiving it doesn't go through
+        #(Part 1 leaves it alone, since it's checked off as Done)
+        plan.add('update_page', 'Archiving this Notion task: ' + pageId, after=[deleteAction], tier=tier, pageId=pageId, properties={
+            On_GCal_Notion_Name: {
+                'checkbox': False
+            },
+        }, archived=True) ##### Delete Notion task
+
+
+
+
+######################################################################
+#METHODS FOR --profile, --trace-memory AND --flame-graph
+#Every phase of a run (planning push, pull and delete, carrying out the plan, finishing what the last run left) can be measured on its own
+#Each phase writes its reports to profileLocation, named after when it started and which phase it was:
+#  .cpu.txt = the PROFILE_TOP_LINES functions that took the longest (cProfile only sees the main thread, so the time the worker threads take
+#             shows up as waiting on them) and .prof = the same in pstats format, e.g. for snakeviz
+#  .memory.txt = the peak memory of the phase and where the most of what was still held at the end got allocated
+#  .folded = what every thread was doing, looked at every FLAME_GRAPH_SAMPLE_SECONDS, one stack per line (turn it into a flame graph with flamegraph.pl)
+#With none of the options given, profiledPhase hands back a context manager that does nothing, so a normal run doesn't pay anything for this
+
+class PhaseProfiler:
+    active = None #only one phase is measured at a time. A phase inside another one (e.g. the outbox being sent while recovering) counts towards the outer one
+    runs = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if PhaseProfiler.active != None:
+            self.name = None
+            return self
+        PhaseProfiler.active = self
+        PhaseProfiler.runs += 1
+        os.makedirs(profileLocation, exist_ok=True)
+        self.path = os.path.join(profileLocation, f'{datetime.now():%Y%m%d-%H%M%S}-{PhaseProfiler.runs:03d}-{self.name}')
+        self.startedAt = time.perf_counter()
+        if args.flame_graph:
+            self.stacks = Counter()
+            self.stopSampling = threading.Event()
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        if args.trace_memory:
+            tracemalloc.start()
+        if args.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.name == None:
+            return False
+        #everything is stopped first, so writing the reports isn't measured too
+        if args.flame_graph:
+            self.stopSampling.set()
+            self.sampler.join()
+        if args.profile:
+            self.profiler.disable()
+        if args.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            tracemalloc.stop()
+        seconds = time.perf_counter() - self.startedAt
+        PhaseProfiler.active = None
+
+        if args.profile:
+            self.profiler.dump_stats(self.path + '.prof')
+            report = io.StringIO()
+            report.write(f'{self.name} took {seconds:.2f}s\n\n')
+            pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP_LINES)
+            with open(self.path + '.cpu.txt', 'w') as f:
+                f.write(report.getvalue())
+        if args.trace_memory:
+            with open(self.path + '.memory.txt', 'w') as f:
+                f.write(f'{self.name} took {seconds:.2f}s, peak memory {peak / 1024 / 1024:.1f} MiB, {current / 1024 / 1024:.1f} MiB still held at the end\n\n')
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP_LINES]:
+                    f.write(f'{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {stat.traceback}\n')
+        if args.flame_graph:
+            with open(self.path + '.folded', 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+        print(f'Wrote the profile of the {self.name} phase ({seconds:.2f}s) to {self.path}.*')
+        return False
+
+    def sample(self):
+        samplerId = threading.get_ident()
+        mainId = threading.main_thread().ident
+        while not self.stopSampling.wait(FLAME_GRAPH_SAMPLE_SECONDS):
+            for threadId, frame in sys._current_frames().items():
+                if threadId == samplerId:
+                    continue
+                #a worker thread that's only waiting for work would fill the graph with nothing, so those are left out
+                if threadId != mainId and os.path.basename(frame.f_code.co_filename) in ('threading.py', 'queue.py'):
+                    continue
+                stack = []
+                while frame != None:
+                    stack.append(f'{frame.f_code.co_name}@{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+def profiledPhase(name):
+    if args.profile or args.trace_memory or args.flame_graph:
+        return PhaseProfiler(name)
+    return nullcontext()
 
 
 
 
 ###########################################################################
-##### Part 5: Deletion Sync -- If marked Done in Notion, then it will delete the GCal event (and the Notion event once Python API updates)
+##### Running the Sync
 ###########################################################################
 
+def planSync(windows, notionEventIds):
+    #windows has the sync window for each phase that should run (the delete phase doesn't use one)
+    plan = SyncPlan()
+    for phase, window in windows.items():
+        actionsBefore = len(plan.actions)
+        callsBefore = apiQuota.usedSoFar()
+        try:
+            with profiledPhase(phase):
+                if phase == 'push':
+                    planNewNotionTasks(plan, window)
+                    planNotionChanges(plan, window)
+                elif phase == 'pull':
+                    planGCalChanges(plan, window)
+                    planNewGCalEvents(plan, window, notionEventIds)
+                elif phase == 'delete':
+                    planDeletions(plan)
+        except Exception as e:
+            if not isUnreachable(e):
+                raise
+            #one of the APIs is down, so this phase waits for the next run while the others carry on
+            print(f'Skipping the {phase} phase this time: ' + str(e))
+            del plan.actions[actionsBefore:]
+            continue
+        finally:
+            plan.readCost[phase] = apiQuota.usedSoFar() - callsBefore
+        for action in plan.actions[actionsBefore:]:
+            plan.changesFound[(phase, action.tier)] += 1
+    optimizePlan(plan)
+    return plan
+
+
+def runPlan(plan):
+    #returns the ids of the actions that didn't go through (failed, left for the next run or waiting in the outbox)
+    if args.dry_run:
+        printPlan(plan)
+        return set()
+    if len(plan.actions) > 0:
+        gcalCalls, gcalRequests, notionCalls = estimateApiCost(plan)
+        print(f"Making {len(plan.actions)} changes, which should take about {gcalCalls} GCal calls ({apiQuota.remaining('GCal')} left today) and {notionCalls} Notion calls ({apiQuota.remaining('Notion')} left today)")
+    with profiledPhase('execute'):
+        notDoneIds = executePlan(plan)
+    clearJournal() #everything has either gone through or failed cleanly, so there's nothing for the next run to clean up
+    outbox.save()
+    gcalEventCache.save()
+    deletionTombstones.save()
+    return notDoneIds
 
-my_page = notion.databases.query( 
-    **{
-        "database_id": database_id,
-        "filter": {
-            "and":[
-                {
-                    "property": GCalEventId_Notion_Name, 
-                    "text":  {
-                        "is_not_empty": True
-                    }
-                }, 
-                {
-                    "property": On_GCal_Notion_Name, 
-                    "checkbox":  {
-                        "equals": True
-                    }
-                },
-                {
-                    "property": Delete_Notion_Name, 
-                    "checkbox":  {
-                        "equals": True
-                    }
+
+######################################################################
+#METHODS FOR backfill
+#The past gets synced one BACKFILL_CHUNK_DAYS long window at a time, oldest first, up to where the regular sync window starts
+#After every chunk the checkpoint file is updated, so running the same backfill again carries on from the last finished chunk
+
+def readBackfillCheckpoint(backfillStart):
+    try:
+        with open(backfillCheckpointLocation) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError): #no backfill has been started yet
+        return backfillStart
+    if checkpoint['backfillStart'] != backfillStart.strftime("%Y-%m-%d"): #the checkpoint is from a backfill with a different start date
+        return backfillStart
+    return datetime.strptime(checkpoint['doneUntil'], "%Y-%m-%d")
+
+
+def saveBackfillCheckpoint(backfillStart, doneUntil):
+    with open(backfillCheckpointLocation, 'w') as f:
+        json.dump({'backfillStart': backfillStart.strftime("%Y-%m-%d"), 'doneUntil': doneUntil.strftime("%Y-%m-%d")}, f)
+
+
+def runBackfill(backfillStart, notionEventIds):
+    backfillEnd = syncWindow()[0]
+    chunkStart = readBackfillCheckpoint(backfillStart)
+    if chunkStart >= backfillEnd:
+        print('Nothing to backfill before ' + backfillEnd.strftime("%Y-%m-%d"))
+        return
+    if chunkStart != backfillStart:
+        print('Carrying on with the backfill from ' + chunkStart.strftime("%Y-%m-%d"))
+
+    totalDays = (backfillEnd - chunkStart).days
+    daysDone = 0
+    changesMade = 0
+    startTime = time.monotonic()
+    while chunkStart < backfillEnd:
+        chunkEnd = min(chunkStart + timedelta(days=BACKFILL_CHUNK_DAYS), backfillEnd)
+        chunkStartTime = time.monotonic()
+
+        chunk = (chunkStart, chunkEnd)
+        plan = planSync({'push': chunk, 'pull': chunk}, notionEventIds) #deleting doesn't depend on the window, so it's left to the regular runs
+        notDoneIds = runPlan(plan)
+        if len(notDoneIds) > 0:
+            #the checkpoint stays where it is, so the next backfill plans this chunk again and only finds what's still missing
+            print(f'{len(notDoneIds)} changes from {chunkStart:%Y-%m-%d} to {chunkEnd:%Y-%m-%d} didn\'t go through (or were left for the next run). Run the same backfill again to carry on from there')
+            return
+        if not args.dry_run:
+            saveBackfillCheckpoint(backfillStart, chunkEnd)
+
+        daysDone += (chunkEnd - chunkStart).days
+        changesMade += len(plan.actions)
+        elapsed = time.monotonic() - startTime
+        print(f'Backfilled {chunkStart:%Y-%m-%d} to {chunkEnd:%Y-%m-%d}: {len(plan.actions)} changes in {time.monotonic() - chunkStartTime:.1f}s '
+            f'({daysDone}/{totalDays} days done, {changesMade / elapsed:.1f} changes/s, {daysDone / elapsed:.1f} days/s)')
+        chunkStart = chunkEnd
+
+    if not args.dry_run: #all done, so the next backfill starts fresh
+        os.remove(backfillCheckpointLocation)
+
+
+######################################################################
+#METHODS FOR import
+#For bringing a whole existing calendar over to Notion in one go (e.g. the first time you set this up)
+#One thread lists the calendars a page at a time and hands the events over to NOTION_MAX_WORKERS threads that make the pages,
+#never faster than NOTION_REQUESTS_PER_SECOND. Each event is written down in the import checkpoint before and after its page is made,
+#so a restarted import skips everything that's already done and double checks the few that were halfway through
+
+class RateLimiter:
+    #lets through at most ratePerSecond calls a second, spread out evenly over all of the threads using it
+    def __init__(self, ratePerSecond):
+        self.interval = 1 / ratePerSecond
+        self.lock = threading.Lock()
+        self.nextTime = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            waitTime = self.nextTime - now
+            self.nextTime = max(self.nextTime, now) + self.interval
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+
+def readImportCheckpoint():
+    done = set()
+    pending = set()
+    try:
+        with open(importCheckpointLocation) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #the last line can be cut off if the import died while writing it
+                    continue
+                if entry['state'] == 'pending':
+                    pending.add(entry['eventId'])
+                else:
+                    pending.discard(entry['eventId'])
+                    done.add(entry['eventId'])
+    except OSError: #no import has been started yet
+        pass
+    return done, pending
+
+
+def notionPageExistsForEvent(eventId):
+    my_page = callApi('Notion', lambda: notion.request(path='databases/' + database_id + '/query', method='POST', query={'filter_properties': [notionPropertyIds[GCalEventId_Notion_Name]]},
+        body={
+            "filter": {
+                "property": GCalEventId_Notion_Name,
+                "text":  {
+                    "equals": eventId
                 }
-            ]
-        },
-    }
-)
+            },
+            "page_size": 1,
+        }))
+    return len(my_page['results']) > 0
+
 
-resultList = my_page['results']
+def bulkImport(calendarNames, notionEventIds):
+    done, pending = readImportCheckpoint()
+    skip = notionEventIds | done
+    eventQueue = queue.Queue(maxsize=NOTION_MAX_WORKERS * 100) #the listing only gets a little ahead of the page making
+    limiter = RateLimiter(NOTION_REQUESTS_PER_SECOND)
+    progress = {'found': 0, 'skipped': 0, 'created': 0, 'failed': 0}
+    progressLock = threading.Lock()
 
-if DELETE_OPTION == 0 and len(resultList) > 0: #delete gCal event (and Notion task once the Python API is updated)
-    CalendarList = []
-    CurrentCalList = []
+    def countProgress(stat):
+        with progressLock:
+            progress[stat] += 1
 
-    for i, el in enumerate(resultList):
-        calendarID = calendarDictionary[el['properties'][Calendar_Notion_Name]['select']['name']]
+    def listEvents():
+        threadService = getThreadService()
+        try:
+            for calendarName in calendarNames:
+                pageToken = None
+                while True: #GCal hands the events back a page at a time, so they start getting imported before the whole calendar is listed
+                    #this is a one-off, so GCal lists out every single time of the recurring events (up to the end of the sync window) instead of us
+                    x = callApi('GCal', threadService.events().list(calendarId=calendarRegistry.idOf[calendarName], maxResults=2500, singleEvents=True, timeMax=googleQueryTime(syncWindow()[1]), pageToken=pageToken, fields=GCAL_LIST_FIELDS).execute)
+                    for item in x['items']:
+                        countProgress('found')
+                        if item['id'] in skip or madeFromNotion(item):
+                            countProgress('skipped')
+                            continue
+                        skip.add(item['id']) #an event can be on more than one of the calendars, but it only gets one page
+                        eventQueue.put((calendarName, item))
+                    pageToken = x.get('nextPageToken')
+                    if pageToken == None:
+                        break
+        finally:
+            for i in range(NOTION_MAX_WORKERS): #tells each page maker that there's nothing left
+                eventQueue.put(None)
+
+    def makePages():
+        while True:
+            work = eventQueue.get()
+            if work == None:
+                return
+            calendarName, item = work
+            try:
+                if item['id'] in pending: #the last import got cut off while making this one, so it might already be there
+                    limiter.wait()
+                    if notionPageExistsForEvent(item['id']):
+                        writeJournalLine({'eventId': item['id'], 'state': 'done'}, importCheckpointLocation)
+                        countProgress('skipped')
+                        continue
+
+                writeJournalLine({'eventId': item['id'], 'state': 'pending'}, importCheckpointLocation)
+                limiter.wait()
+                properties = makeNotionPageForEvent(item, calendarRegistry.idOf[calendarName])
+                callApi('Notion', lambda: notion.pages.create(**{"parent": {"database_id": database_id}, "properties": properties}), idempotent=False)
+            except Exception as e: #the page gets tried again on the next import
+                print('Could not add this event to Notion: ' + item.get('summary', item['id']) + ': ' + str(e))
+                countProgress('failed')
+                continue
+            writeJournalLine({'eventId': item['id'], 'state': 'done'}, importCheckpointLocation)
+            countProgress('created')
+
+    if len(done) > 0:
+        print(f'Carrying on with the import, {len(done)} events were already brought over')
+
+    startTime = time.monotonic()
+    lister = gcalPool.submit(listEvents)
+    pageMakers = [notionPool.submit(makePages) for i in range(NOTION_MAX_WORKERS)]
+    while not all(pageMaker.done() for pageMaker in pageMakers):
+        time.sleep(5)
+        with progressLock:
+            found, skipped, created, failed = progress['found'], progress['skipped'], progress['created'], progress['failed']
+        rate = created / (time.monotonic() - startTime)
+        left = found - skipped - created - failed
+        if rate > 0:
+            eta = f'{timedelta(seconds=int(left / rate))}' + (' so far (still listing)' if not lister.done() else '')
+        else:
+            eta = 'unknown'
+        print(f'Imported {created} of {found - skipped} events ({skipped} already there, {failed} failed), {rate:.1f} events/s, ETA {eta}')
+
+    lister.result() #if listing the calendar failed, this is where we find out
+    for pageMaker in pageMakers:
+        pageMaker.result()
+    print(f"Import finished: {progress['created']} pages made in {timedelta(seconds=int(time.monotonic() - startTime))}, {progress['skipped']} events were already there, {progress['failed']} failed")
+    if progress['failed'] == 0 and os.path.exists(importCheckpointLocation): #all done, so the next import starts fresh
+        os.remove(importCheckpointLocation)
+    elif progress['failed'] > 0:
+        print('Run the same import again to retry the ones that failed')
+
+
+######################################################################
+#METHODS FOR reconcile
+#Instead of downloading everything from both sides to find out if they've drifted apart, only the id, calendar and times of each event are listed
+#(a few list calls for a whole year) and turned into a tree of hashes: one per day, then one per month and calendar made from the ones under it
+#If the two roots match, everything agrees. If not, only the branches whose hashes differ are followed down to the days that don't match,
+#and the regular sync is run over just those days
+
+VERIFY_GCAL_FIELDS = 'nextPageToken,items(id,status,start,end)'
+
+def verifyWindow():
+    today = datetime.combine(date.today(), datetime.min.time())
+    return args.windowStart if args.windowStart != None else today - timedelta(days=VERIFY_PAST_DAYS), syncWindow()[1]
+
+
+def hashOf(lines):
+    return hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+
+def eventFingerprint(eventId, calendarId, start, end):
+    #the same things Part 3 compares, so an event that's in sync looks exactly the same from both sides
+    return '|'.join([eventId, calendarId, start.isoformat(), end.isoformat()])
+
+
+def listGCalFingerprints(threadService, lookup):
+    calendarId, window = lookup
+    windowStart, windowEnd = toLocalTime(window[0]), toLocalTime(window[1])
+    fingerprints = []
+    pageToken = None
+    while True:
+        #Notion keeps a page for every time a recurring event happens, so GCal is asked for them one by one here too
+        x = callApi('GCal', threadService.events().list(calendarId=calendarId, maxResults=2500, singleEvents=True, timeMin=googleQueryTime(windowStart), timeMax=googleQueryTime(windowEnd), pageToken=pageToken, fields=VERIFY_GCAL_FIELDS).execute)
+        for item in x['items']:
+            start = parseGCalTime(item['start'], isEnd=False)
+            if item['status'] == 'cancelled' or start < windowStart: #GCal also lists events that started before the window but end inside it
+                continue
+            fingerprints.append((calendarId, start, eventFingerprint(item['id'], calendarId, start, parseGCalTime(item['end'], isEnd=True))))
+        pageToken = x.get('nextPageToken')
+        if pageToken == None:
+            return fingerprints
+
+
+def listNotionFingerprints(window):
+    #also returns the event ids of the tasks checked off as Done. The sync doesn't touch those any more (their events stay on GCal
+    #until Part 5 deletes them, or for good with DELETE_OPTION = 1), so they're left out of both sides instead of showing up as drift every time
+    my_page = queryNotionDatabase(
+        **{
+            "database_id": database_id,
+            "filter": {
+                "and": [
+                    {
+                        "property": GCalEventId_Notion_Name,
+                        "text":  {
+                            "is_not_empty": True
+                        }
+                    },
+                    {
+                        "property": On_GCal_Notion_Name,
+                        "checkbox":  {
+                            "equals": True
+                        }
+                    },
+                    notionWindowFilter(window),
+                ]
+            },
+        },
+        properties=[GCalEventId_Notion_Name, Date_Notion_Name, Calendar_Notion_Name, Current_Calendar_Id_Notion_Name, Delete_Notion_Name],
+    )
+    fingerprints = []
+    doneEventIds = set()
+    for el in my_page['results']:
         eventId = el['properties'][GCalEventId_Notion_Name]['rich_text'][0]['text']['content']
+        if el['properties'][Delete_Notion_Name]['checkbox']:
+            doneEventIds.add(eventId)
+            continue
+        calendarId = calendarRegistry.currentId(el['properties']) or calendarRegistry.selectedId(el['properties']) or calendarRegistry.defaultId #the calendar the event is actually on
+        start = parseNotionDate(el['properties'][Date_Notion_Name]['date']['start'])
+        end = start #same as in Part 3, a task with no end is compared as if it ends when it starts
+        if el['properties'][Date_Notion_Name]['date']['end'] != None:
+            end = parseNotionDate(el['properties'][Date_Notion_Name]['date']['end'])
+        fingerprints.append((calendarId, start, eventFingerprint(eventId, calendarId, start, end)))
+    return fingerprints, doneEventIds
+
+
+def buildHashTree(fingerprints):
+    #calendar id -> month -> day -> the fingerprints of the events starting that day
+    tree = {}
+    for calendarId, start, fingerprint in fingerprints:
+        tree.setdefault(calendarId, {}).setdefault(start.strftime('%Y-%m'), {}).setdefault(start.strftime('%Y-%m-%d'), []).append(fingerprint)
+
+    def makeNode(children):
+        if isinstance(children, list): #a day
+            events = sorted(children)
+            return {'hash': hashOf(events), 'events': events}
+        nodes = {key: makeNode(value) for key, value in sorted(children.items())}
+        return {'hash': hashOf(key + ':' + node['hash'] for key, node in nodes.items()), 'children': nodes}
+    return makeNode(tree)
+
+
+def differingDays(gcalNode, notionNode, path=()):
+    #returns the (calendar id, month, day) of every day that doesn't match, only going down the branches whose hashes differ
+    if gcalNode != None and notionNode != None and gcalNode['hash'] == notionNode['hash']:
+        return []
+    if len(path) == 3:
+        return [path]
+    gcalChildren = gcalNode['children'] if gcalNode != None else {}
+    notionChildren = notionNode['children'] if notionNode != None else {}
+    days = []
+    for key in sorted(set(gcalChildren) | set(notionChildren)):
+        days.extend(differingDays(gcalChildren.get(key), notionChildren.get(key), path + (key,)))
+    return days
+
+
+def dayEvents(node, path):
+    for key in path:
+        node = node['children'].get(key) if node != None else None
+    return set(node['events']) if node != None else set()
+
+
+def runReconcile():
+    window = verifyWindow()
+    print(f'Checking that Notion and GCal agree from {window[0]:%Y-%m-%d} to {window[1]:%Y-%m-%d}')
+    calendarIds = sorted(calendarRegistry.idOf[calendarName] for calendarName in calendarRegistry.syncedNames())
+    with profiledPhase('verify'):
+        gcalFingerprints = [fingerprint for calendarFingerprints in fanOutCalendarReads(listGCalFingerprints, [(calendarId, window) for calendarId in calendarIds]) for fingerprint in calendarFingerprints]
+        notionFingerprints, doneEventIds = listNotionFingerprints(window)
+        gcalTree = buildHashTree([fingerprint for fingerprint in gcalFingerprints if fingerprint[2].split('|')[0] not in doneEventIds])
+        notionTree = buildHashTree(notionFingerprints)
+
+    drifted = differingDays(gcalTree, notionTree)
+    for path in drifted:
+        gcalEvents, notionEvents = dayEvents(gcalTree, path), dayEvents(notionTree, path)
+        print(f'{path[2]} on {path[0]}: {len(gcalEvents - notionEvents)} only on GCal (or different there), {len(notionEvents - gcalEvents)} only in Notion (or different there)')
+    with open(verifyReportLocation, 'w') as f:
+        json.dump({'checkedAt': datetime.now().isoformat(timespec='seconds'), 'from': window[0].strftime('%Y-%m-%d'), 'to': window[1].strftime('%Y-%m-%d'),
+            'gcalRoot': gcalTree['hash'], 'notionRoot': notionTree['hash'], 'driftedDays': [{'calendarId': path[0], 'day': path[2]} for path in drifted]}, f, indent=2)
+
+    if len(drifted) == 0:
+        print('Everything agrees')
+        return
+    print(f'{len(drifted)} days don\'t agree, so those get synced')
+
+    #the drifted days (on any calendar) are merged into runs of days in a row, and each run gets synced like a backfill chunk
+    days = sorted({datetime.strptime(path[2], '%Y-%m-%d') for path in drifted})
+    chunks = []
+    for day in days:
+        if len(chunks) > 0 and chunks[-1][1] == day:
+            chunks[-1][1] = day + timedelta(days=1)
+        else:
+            chunks.append([day, day + timedelta(days=1)])
+    notionEventIds = getNotionEventIds()
+    for chunkStart, chunkEnd in chunks:
+        chunk = (chunkStart, chunkEnd)
+        notDoneIds = runPlan(planSync({'push': chunk, 'pull': chunk}, notionEventIds))
+        if len(notDoneIds) > 0: #those days still don't agree, so the next reconcile finds them again
+            print(f'{len(notDoneIds)} changes didn\'t go through (or were left for the next run), so the rest of the days wait for the next reconcile')
+            return
 
-        
-        pageId = el['id']
-        
-        print(calendarID, eventId)
 
-        try:
-            service.events().delete(calendarId=calendarID, eventId=eventId).execute() 
-        except:
+######################################################################
+#METHODS FOR daemon
+#Every phase that uses the sync window is split into one job per priority tier (the delete phase is just one job), and every job has its own wait
+#Each time a job finds changes its wait is halved (down to DAEMON_MIN_INTERVAL), and once it has found nothing DAEMON_IDLE_CYCLES times in a row
+#its wait keeps getting DAEMON_BACKOFF times longer (up to DAEMON_MAX_INTERVAL, or the tier's maxWait if that's shorter)
+#So today's events get checked every minute or so while they're being edited, and next month's only every few hours when nothing is going on
+
+def daemonJobs(phases):
+    jobs = [(phase, tierName) for phase in ('push', 'pull') if phase in phases for tierName in SYNC_TIERS]
+    if 'delete' in phases:
+        jobs.append(('delete', None))
+    return jobs
+
+
+def jobName(job):
+    phase, tierName = job
+    return phase if tierName == None else phase + '/' + tierName
+
+
+class PhaseScheduler:
+    def __init__(self, jobs):
+        now = time.monotonic()
+        self.jobs = jobs
+        self.intervals = {job: self.waitLimits(job)[0] for job in jobs}
+        self.idleCycles = {job: 0 for job in jobs}
+        self.nextRun = {job: now for job in jobs} #everything runs right away the first time
+        self.readCost = {job: Counter() for job in jobs} #how many calls to each API the job's reads took the last time it ran
+
+    def waitLimits(self, job):
+        phase, tierName = job
+        cadence = PHASE_CADENCE[phase] * (SYNC_TIERS[tierName]['cadence'] if tierName != None else 1)
+        shortest = DAEMON_MIN_INTERVAL * cadence
+        longest = DAEMON_MAX_INTERVAL * cadence
+        if tierName != None:
+            longest = min(longest, SYNC_TIERS[tierName]['maxWait'])
+        return shortest, max(shortest, longest)
+
+    def secondsUntilNextRun(self):
+        return max(0, min(self.nextRun.values()) - time.monotonic())
+
+    def dueJobs(self):
+        now = time.monotonic()
+        return [job for job in self.jobs if self.nextRun[job] <= now]
+
+    def recordReadCost(self, jobs, readCost):
+        #a phase reads the window of all its due tiers in one go, so what it took is shared out evenly between them
+        for phase, cost in readCost.items():
+            phaseJobs = [job for job in jobs if job[0] == phase]
+            for job in phaseJobs:
+                self.readCost[job] = Counter({api: math.ceil(count / len(phaseJobs)) for api, count in cost.items()})
+
+    def postpone(self, jobs):
+        #another run had the lock, so these jobs are tried again after their shortest wait without it counting as a check
+        for job in jobs:
+            self.nextRun[job] = time.monotonic() + self.waitLimits(job)[0]
+
+    def record(self, job, changes):
+        shortest, longest = self.waitLimits(job)
+        if changes > 0:
+            self.idleCycles[job] = 0
+            self.intervals[job] = max(shortest, self.intervals[job] / 2)
+        else:
+            self.idleCycles[job] += 1
+            if self.idleCycles[job] >= DAEMON_IDLE_CYCLES:
+                self.intervals[job] = min(longest, self.intervals[job] * DAEMON_BACKOFF)
+        self.nextRun[job] = time.monotonic() + self.intervals[job]
+
+
+def runDaemon():
+    scheduler = PhaseScheduler(daemonJobs(args.phases))
+    while True:
+        time.sleep(scheduler.secondsUntilNextRun())
+        jobs = scheduler.dueJobs()
+
+        #Before anything is read, each due job is expected to take as many calls as its reads did last time (Part 3 alone can be one
+        #call per event per calendar). The jobs are let in most urgent first while that still leaves the QUOTA_RESERVE of today's budgets,
+        #and the rest wait for their next turn. The first tier and deletions always get checked
+        firstTier = list(SYNC_TIERS.keys())[0]
+        jobs.sort(key=lambda job: tierRank(job[1]) if job[1] != None else 0)
+        predicted = Counter()
+        keptJobs = []
+        for job in jobs:
+            if job[1] in (None, firstTier) or not apiQuota.wouldRunLow(predicted + scheduler.readCost[job]):
+                keptJobs.append(job)
+                predicted += scheduler.readCost[job]
+            else:
+                print(f'Holding back {jobName(job)} to keep some of today\'s API budget for the events coming up soonest')
+                scheduler.record(job, 0)
+        jobs = keptJobs
+        if len(jobs) == 0:
             continue
-        
-        my_page = notion.pages.update( ##### Delete Notion task (diesn't work yet)
-            **{
-                "page_id": pageId, 
-                "archived": True, 
-                "properties":{} 
-            },
-        )
 
-        print(my_page)
+        #the lock is only held for the check itself, so a push from cron (or another daemon) can go in while this one waits
+        if not args.dry_run and not runLock.acquire(wait=args.wait):
+            recordSkippedRun()
+            scheduler.postpone(jobs)
+            continue
+        print('\n' + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ' Syncing: ' + ', '.join(jobName(job) for job in jobs))
+
+        #each phase only looks at the part of the sync window that its due tiers cover
+        windows = {}
+        for phase in SYNC_PHASES:
+            tierNames = [tierName for jobPhase, tierName in jobs if jobPhase == phase]
+            if len(tierNames) > 0:
+                windows[phase] = None if phase == 'delete' else tierWindow(tierNames, syncWindow())
+
+        try:
+            refreshNotionSchemaIfStale()
+            if not args.dry_run: #finishes whatever a failed sync before this one left hanging, then sends what's waiting in the outbox
+                with profiledPhase('recover'):
+                    recoverJournal()
+                    flushOutbox()
+            calendarRegistry.refreshIfStale()
+            callsBefore = apiQuota.usedSoFar()
+            notionEventIds = getNotionEventIds() if 'pull' in windows else set()
+            idsCost = apiQuota.usedSoFar() - callsBefore
+            plan = planSync(windows, notionEventIds)
+            if 'pull' in plan.readCost: #reading the Notion event ids is part of what pulling costs
+                plan.readCost['pull'] += idsCost
+            scheduler.recordReadCost(jobs, plan.readCost)
+            runPlan(plan)
+            changesFound = plan.changesFound
+        except Exception as e: #the internet dropping out or an API hiccup shouldn't stop the daemon, it just counts as a check that found nothing
+            print('This sync failed and will be tried again later: ' + str(e))
+            changesFound = Counter()
+        apiQuota.save()
+        runLock.release()
+        for job in jobs:
+            phase, tierName = job
+            scheduler.record(job, sum(count for (foundPhase, foundTier), count in changesFound.items() if foundPhase == phase and (tierName == None or foundTier == tierName)))
+        printConnectionReport()
+        print('Next checks: ' + ', '.join(f'{jobName(job)} in {int(scheduler.intervals[job])}s' for job in jobs))
+
+
+if args.dry_run: #a dry run doesn't change anything, so it only says what is left over from a run that got cut off
+    for entry in readUnfinishedJournalEntries():
+        print('Left over from a run that got cut off (gets finished on the next real run): ' + entry['action']['description'])
+    for action in outbox.actions:
+        print('Waiting in the outbox (gets sent on the next real run): ' + action.description)
+elif args.command not in ('conflicts', 'daemon'): #conflicts doesn't take the lock, so the journal and outbox might belong to a run that's syncing right now (the daemon recovers at the start of every check)
+    with profiledPhase('recover'):
+        recoverJournal()
+        flushOutbox()
+
+if args.command == 'daemon':
+    runDaemon()
+elif args.command == 'import':
+    with profiledPhase('import'):
+        bulkImport(calendarRegistry.syncedNames(), getNotionEventIds())
+elif args.command == 'conflicts':
+    printConflicts(syncWindow())
+elif args.command == 'reconcile':
+    runReconcile()
+elif args.command == 'backfill':
+    runBackfill(args.since, getNotionEventIds())
+else:
+    #First everything the command's phases need gets read and planned (the Notion event ids are only needed to pull)...
+    phases = COMMAND_PHASES[args.command]
+    plan = planSync({phase: syncWindow() for phase in phases}, getNotionEventIds() if 'pull' in phases else set())
+
+    if args.plan_file != None:
+        with open(args.plan_file, 'w') as f:
+            f.write(plan.toJson())
+
+    #...then it all gets carried out
+    runPlan(plan)
+
+apiQuota.save()
+printConnectionReport()
@@ -1,5 +1,6 @@
 @echo off
 :loop 
-@python "FULL_PATH_TO_PYTHON_FILE_HERE"
-timeout /t 300
+REM the daemon command works out by itself how often to sync, this loop only starts it again if it ever stops
+@python "FULL_PATH_TO_PYTHON_FILE_HERE" daemon
+timeout /t 60
 goto :loop 
\ No newline at end of file